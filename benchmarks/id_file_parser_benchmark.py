@@ -0,0 +1,197 @@
+"""Throughput of the id_file_parser engines in PSMs per second on synthetic id files."""
+
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from immuno_ms2rescore_tools.id_file_parser import _IdFileParser
+
+AMINO_ACIDS = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+
+
+def _random_peptides(n_psms, n_peptides, rng):
+    """n_psms peptides drawn from n_peptides unique sequences, like repeated immunopeptide hits"""
+
+    lengths = rng.integers(8, 13, n_peptides)
+    peptides = np.array(["".join(rng.choice(AMINO_ACIDS, length)) for length in lengths])
+    return peptides[rng.integers(0, n_peptides, n_psms)]
+
+
+def _modify(peptides, tag, rng):
+    """Insert tag after the first M of about half of the peptides"""
+
+    modified = pd.Series(peptides).str.replace("M", f"M{tag}", n=1, regex=False)
+    return np.where(rng.random(len(peptides)) < 0.5, modified, peptides)
+
+
+def maxquant_fixture(folder, n_psms, n_peptides, rng):
+    peptides = _random_peptides(n_psms, n_peptides, rng)
+    msms = pd.DataFrame(
+        {
+            "Raw file": [f"run{i % 10}" for i in range(n_psms)],
+            "Scan number": rng.integers(1, 100000, n_psms),
+            "Sequence": peptides,
+            "Modified sequence": "_" + _modify(peptides, "(ox)", rng) + "_",
+            "Charge": rng.integers(1, 5, n_psms),
+            "Score": rng.random(n_psms) * 200,
+            "Retention time": rng.random(n_psms) * 120,
+            "Reverse": np.where(rng.random(n_psms) < 0.1, "+", ""),
+            "Masses": "147.11;260.19;373.28",
+            "Intensities": "1000;2000;3000",
+        }
+    )
+    path = os.path.join(folder, "msms.txt")
+    msms.to_csv(path, sep="\t", index=False)
+    return path
+
+
+def comet_fixture(folder, n_psms, n_peptides, rng):
+    peptides = _random_peptides(n_psms, n_peptides, rng)
+    scans = rng.integers(1, 100000, n_psms)
+    charges = rng.integers(1, 5, n_psms)
+    comet = pd.DataFrame(
+        {
+            "ScanNr": scans,
+            "Sequence": peptides,
+            "Peptide": _modify(peptides, "(Oxidation)", rng),
+            "Charge": charges,
+            "Comet.SpScore": rng.random(n_psms) * 1000,
+            "RT": rng.random(n_psms) * 120,
+            "IsDecoy": rng.random(n_psms) < 0.1,
+            "Spectrum": [f"run{i % 10}.{s}.{s}.{c}" for i, (s, c) in enumerate(zip(scans, charges))],
+        }
+    )
+    path = os.path.join(folder, "comet.txt")
+    comet.to_csv(path, sep="\t", index=False)
+    return path
+
+
+def spectrum_mill_fixture(folder, n_psms, n_peptides, rng):
+    peptides = _random_peptides(n_psms, n_peptides, rng)
+    scans = rng.integers(1, 100000, n_psms)
+    spectrum_mill = pd.DataFrame(
+        {
+            "filename": [f"run{i % 10}.{s}.{s}.2" for i, s in enumerate(scans)],
+            # Spectrum Mill marks modified residues in lower case
+            "sequence": np.where(
+                rng.random(n_psms) < 0.5,
+                pd.Series(peptides).str.replace("M", "m", n=1, regex=False),
+                peptides,
+            ),
+            "parent_charge": rng.integers(1, 5, n_psms),
+            "score": rng.random(n_psms) * 20,
+            "retentionTimeMin": rng.random(n_psms) * 120,
+        }
+    )
+    path = os.path.join(folder, "spectrum_mill.ssv")
+    spectrum_mill.to_csv(path, sep=";", index=False)
+    return path
+
+
+def proteome_discoverer_fixture(folder, n_psms, n_peptides, rng):
+    peptides = _random_peptides(n_psms, n_peptides, rng)
+    modifications = np.where(
+        rng.random(n_psms) < 0.5, "N-Term(TMT6plex); K1(TMT6plex)", "M1(Oxidation)"
+    )
+    proteome_discoverer = pd.DataFrame(
+        {
+            "Spectrum File": [f"run{i % 10}.raw" for i in range(n_psms)],
+            "PSMs Peptide ID": np.arange(n_psms),
+            "Sequence": peptides,
+            "Modifications": modifications,
+            "Charge": rng.integers(1, 5, n_psms),
+            "DeltaScore": rng.random(n_psms),
+            "RT [min]": rng.random(n_psms) * 120,
+            "Percolator q-Value": rng.random(n_psms) * 0.05,
+        }
+    )
+    path = os.path.join(folder, "psms.txt")
+    proteome_discoverer.to_csv(path, sep="\t", index=False)
+    return path
+
+
+def peaks_fixture(folder, n_psms, n_peptides, rng):
+    """mzIdentML with two ranked SpectrumIdentificationItems per spectrum, like PEAKS exports"""
+
+    peptides = _random_peptides(n_peptides, n_peptides, rng)
+    oxidized = rng.random(n_peptides) < 0.5
+    decoys = rng.random(n_peptides) < 0.1
+    path = os.path.join(folder, "peaks.mzid")
+    with open(path, "w") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<MzIdentML id="benchmark" version="1.1.0" xmlns="http://psidev.info/psi/pi/mzIdentML/1.1">\n'
+            "<SequenceCollection>\n"
+            '<DBSequence id="DB0" accession="P00000" searchDatabase_ref="SDB"/>\n'
+        )
+        for i, peptide in enumerate(peptides):
+            modification = (
+                f'<Modification location="{peptide.find("M") + 1}" monoisotopicMassDelta="15.99" residues="M">'
+                '<cvParam cvRef="UNIMOD" accession="UNIMOD:35" name="Oxidation"/></Modification>'
+                if oxidized[i] and "M" in peptide
+                else ""
+            )
+            f.write(f'<Peptide id="PEP{i}"><PeptideSequence>{peptide}</PeptideSequence>{modification}</Peptide>\n')
+        for i in range(n_peptides):
+            f.write(
+                f'<PeptideEvidence id="PE{i}" peptide_ref="PEP{i}" dBSequence_ref="DB0" '
+                f'isDecoy="{"true" if decoys[i] else "false"}"/>\n'
+            )
+        f.write("</SequenceCollection>\n<DataCollection><Inputs>\n")
+        for run in range(10):
+            f.write(f'<SpectraData id="SD{run}" location="/data/run{run}.mgf"/>\n')
+        f.write('</Inputs>\n<AnalysisData><SpectrumIdentificationList id="SIL">\n')
+        ranked_peptides = rng.integers(0, n_peptides, (n_psms, 2))
+        charges = rng.integers(1, 5, n_psms)
+        scores = np.sort(rng.random((n_psms, 2)) * 100, axis=1)[:, ::-1]
+        for i in range(n_psms):
+            f.write(f'<SpectrumIdentificationResult id="SIR{i}" spectrumID="index={i}" spectraData_ref="SD{i % 10}">\n')
+            for rank in range(2):
+                f.write(
+                    f'<SpectrumIdentificationItem id="SII{i}_{rank + 1}" rank="{rank + 1}" '
+                    f'chargeState="{charges[i]}" peptide_ref="PEP{ranked_peptides[i, rank]}" passThreshold="true">'
+                    f'<PeptideEvidenceRef peptideEvidence_ref="PE{ranked_peptides[i, rank]}"/>'
+                    f'<cvParam cvRef="PSI-MS" accession="MS:1001950" name="PEAKS:peptideScore" value="{scores[i, rank]:.4f}"/>'
+                    "</SpectrumIdentificationItem>\n"
+                )
+            f.write("</SpectrumIdentificationResult>\n")
+        f.write("</SpectrumIdentificationList></AnalysisData></DataCollection></MzIdentML>\n")
+    return path
+
+
+FIXTURES = {
+    "Maxquant": maxquant_fixture,
+    "Comet": comet_fixture,
+    "SpectrumMill": spectrum_mill_fixture,
+    "ProteomeDiscoverer": proteome_discoverer_fixture,
+    "Peaks": peaks_fixture,
+}
+
+
+@click.command()
+@click.option("--psms", default=1000000, show_default=True, help="number of PSMs per id file")
+@click.option("--peptides", default=20000, show_default=True, help="number of unique peptides")
+@click.option("--repeats", default=3, show_default=True, help="best of this many runs is reported")
+@click.option("--search_engine", multiple=True, help="only benchmark these engines, default = all")
+def main(psms, peptides, repeats, search_engine):
+    rng = np.random.default_rng(42)
+    with tempfile.TemporaryDirectory() as folder:
+        for engine, fixture in FIXTURES.items():
+            if search_engine and engine not in search_engine:
+                continue
+            path = fixture(folder, psms, peptides, rng)
+            timings = []
+            for _ in range(repeats):
+                parser = _IdFileParser.get_id_file_parser(engine, path)
+                start = time.perf_counter()
+                parser.to_peprec()
+                timings.append(time.perf_counter() - start)
+            print(f"{engine:<20}{psms / min(timings):>14,.0f} PSMs/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,175 @@
 
 import re
 import os
-from math import log2, sqrt, acos
+import io
+import gzip
+import hashlib
+import json
+import mmap
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from math import sqrt, acos, ceil
+from pathlib import Path
 from scipy.stats import pearsonr
 import pandas as pd
 import numpy as np
 
 from sqlalchemy import true
 from tqdm import tqdm
-from pyteomics.auxiliary import target_decoy
 from pyteomics import mgf
+from pyteomics.auxiliary import Charge
+
+from immuno_ms2rescore_tools.peprec_io import (
+    PEPREC_DTYPES,
+    get_binary_format,
+    iter_peprec,
+    read_peprec,
+    write_binary_peprec,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+MGF_EXTENSIONS = ("mgf", "mgf.gz", "mgf.zst")
+
+
+def open_mgf(mgf_file, mode="r"):
+    """
+    Open a plain, gzip or zstd compressed MGF file as a stream
+
+    Compressed files are decompressed on the fly, gzip files are decompressed
+    in a background thread if python-isal is installed. Compressed binary
+    streams can only seek forward, see MGFIndex.read_spectrum_text.
+    """
+
+    if mode not in ("r", "rb"):
+        raise ValueError("MGF files can only be opened for reading")
+    if mgf_file.endswith(".gz"):
+        if igzip_threaded is not None:
+            f = igzip_threaded.open(mgf_file, "rb", threads=1)
+        else:
+            f = gzip.open(mgf_file, "rb")
+    elif mgf_file.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("zstandard is required to read .zst compressed MGF files")
+        f = io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(open(mgf_file, "rb"), closefd=True)
+        )
+    else:
+        return open(mgf_file, mode)
+    if mode == "r":
+        return io.TextIOWrapper(f)
+    return f
+
+
+def _get_mgf_stem(mgf_file):
+    """Strip the folder and compression extension from an MGF filename"""
+
+    filename = mgf_file.rsplit("/", 1)[-1]
+    for extension in (".gz", ".zst"):
+        if filename.endswith(extension):
+            filename = filename[: -len(extension)]
+    return filename
+
+
+class FileManifest:
+    """
+    Manifest of the input files seen in a previous run
+
+    Every file is recorded with its size, mtime and a cheap content
+    fingerprint (a hash of the size and the first and last 64 KiB), plus
+    optional cached per-file results. Comparing a filelist against the
+    manifest tells which files are new, changed or unchanged.
+
+    Only MascotGenericFormat.count_spectra caches results in the manifest.
+    scan_mgf output depends on the peprec as well as on the MGF files and
+    the id file parsers are out of scope, they always read all inputs.
+    """
+
+    fingerprint_block = 1 << 16
+
+    def __init__(self, manifest_file) -> None:
+        self.manifest_file = manifest_file
+        self.files = dict()
+        if os.path.isfile(manifest_file):
+            try:
+                with open(manifest_file, "r") as f:
+                    self.files = json.load(f)["files"]
+            except (OSError, ValueError, KeyError):
+                self.files = dict()
+
+    @classmethod
+    def fingerprint(cls, path, size):
+        digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(path, "rb") as f:
+            digest.update(f.read(cls.fingerprint_block))
+            if size > cls.fingerprint_block:
+                f.seek(max(cls.fingerprint_block, size - cls.fingerprint_block))
+                digest.update(f.read(cls.fingerprint_block))
+        return digest.hexdigest()
+
+    def compare(self, filelist):
+        """
+        Classify files as new, changed or unchanged and update the manifest
+
+        Unchanged files keep their cached results, the results of new and
+        changed files are reset.
+        """
+
+        status = {"new": [], "changed": [], "unchanged": []}
+        for path in filelist:
+            key = os.path.abspath(path)
+            stat = os.stat(path)
+            record = self.files.get(key)
+            if (
+                record is not None
+                and record["size"] == stat.st_size
+                and record["mtime"] == stat.st_mtime_ns
+            ):
+                status["unchanged"].append(path)
+                continue
+            fingerprint = self.fingerprint(path, stat.st_size)
+            results = dict()
+            if record is None:
+                status["new"].append(path)
+            elif record["size"] == stat.st_size and record["fingerprint"] == fingerprint:
+                status["unchanged"].append(path)
+                results = record["results"]
+            else:
+                status["changed"].append(path)
+            self.files[key] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "fingerprint": fingerprint,
+                "results": results,
+            }
+        return status
+
+    def get_result(self, path, name):
+        record = self.files.get(os.path.abspath(path))
+        if record is None:
+            return None
+        return record["results"].get(name)
+
+    def set_result(self, path, name, value):
+        self.files[os.path.abspath(path)]["results"][name] = value
+
+    def save(self):
+        with open(self.manifest_file, "w") as f:
+            json.dump({"files": self.files}, f)
 
 
 class FileHandeling:
@@ -18,7 +178,8 @@ class FileHandeling:
 
     def __init__(self) -> None:
         self.filelist = []
-        pass
+        self.manifest = None
+        self.file_status = None
 
     def retrieve_files(self, path, file_extension=None, recursive=False):
         if os.path.isfile(path):
@@ -26,37 +187,99 @@ class FileHandeling:
         elif os.path.isdir(path):
             dirs = []
             files = []
-            for object in os.listdir(path):
-                object_path = os.path.join(path, object)
-                if os.path.isfile(object_path) and object_path.endswith(
-                    "." + file_extension
-                ):
-                    files.append(object_path)
-                elif os.path.isdir(object_path):
-                    dirs.append(object_path)
+            if isinstance(file_extension, str):
+                extensions = "." + file_extension
+            else:
+                extensions = tuple("." + extension for extension in file_extension)
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(extensions):
+                        files.append(entry.path)
+                    elif entry.is_dir():
+                        dirs.append(entry.path)
             if recursive:
-                for directories in dirs:
-                    dirs = []
-                    FileHandeling.retrieve_files(self, directories, file_extension)
-                os.chdir("..")
+                for directory in dirs:
+                    self.retrieve_files(directory, file_extension, recursive=True)
             self.filelist.extend(files)
         else:
             raise TypeError("Not a valid file or directory")
 
-    def combine_peprec_files(self, filelist=None):
+    def check_manifest(self, manifest_file):
+        """
+        Compare the filelist with the manifest of a previous run
+
+        output:
+        dictionary with new, changed and unchanged files
+        """
+
+        self.manifest = FileManifest(manifest_file)
+        self.file_status = self.manifest.compare(self.filelist)
+        return self.file_status
+
+    @staticmethod
+    def _read_peprec(filename, columns=None, dtype=None):
+        """Read a space separated or binary peprec with an explicit dtype map"""
+
+        dtype = dict(PEPREC_DTYPES, **(dtype or {}))
+        if get_binary_format(filename):
+            return read_peprec(filename, columns=columns)
+        return read_peprec(
+            filename,
+            columns=columns,
+            dtype=dtype,
+            keep_default_na=False,
+            na_values={
+                column: [""] for column, column_dtype in dtype.items() if column_dtype != str
+            },
+        )
+
+    def combine_peprec_files(self, filelist=None, columns=None, dtype=None, workers=1, join="inner"):
+        """
+        Combine peprec files into one dataframe
+
+        Parameters
+        ----------
+        filelist: list
+            peprec files, default = self.filelist
+        columns: list
+            only read these columns, default = all columns
+        dtype: dict
+            dtypes overriding PEPREC_DTYPES
+        workers: int
+            number of threads reading files in parallel, default = 1
+        join: str
+            inner (default) keeps the columns shared by all files, outer keeps all
+
+        Columns missing from some of the files are printed and stored in
+        self.schema_mismatches as {filename: missing columns}.
+        """
         if filelist:
             self.filelist = filelist
-        peprecs = []
-        for filename in self.filelist:
-            peprecs.append(pd.read_table(filename, sep=" "))
-        peprec = pd.concat(peprecs, ignore_index=True, join="inner")
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            peprecs = list(
+                executor.map(lambda f: self._read_peprec(f, columns, dtype), self.filelist)
+            )
+
+        all_columns = []
+        for peprec in peprecs:
+            all_columns.extend(c for c in peprec.columns if c not in all_columns)
+        self.schema_mismatches = dict()
+        for filename, peprec in zip(self.filelist, peprecs):
+            missing = [c for c in all_columns if c not in peprec.columns]
+            if missing:
+                self.schema_mismatches[filename] = missing
+        if self.schema_mismatches:
+            print(
+                f"Columns missing in {len(self.schema_mismatches)} peprec file(s), "
+                f"{'dropped' if join == 'inner' else 'filled with NaN'}: {self.schema_mismatches}"
+            )
+
+        peprec = pd.concat(peprecs, ignore_index=True, join=join)
+        for column, column_dtype in dict(PEPREC_DTYPES, **(dtype or {})).items():
+            if column_dtype == "category" and column in peprec.columns:
+                peprec[column] = peprec[column].astype("category")
         return peprec
 
-    @staticmethod
-    def _calculate_log2_intensity(intensity):
-        """calculate the log2 instensity"""
-        return log2(intensity + 0.001)
-    
     @staticmethod
     def ms2pip_pearson(true, pred):
         """
@@ -90,129 +313,799 @@ class FileHandeling:
 
         return spectral_angle
 
+    @staticmethod
+    def batch_correlations(true, pred, offsets, epsilon=1e-7):
+        """
+        Calculate PCC and spectral angle for many spectra at once
+
+        Parameters
+        ----------
+        true, pred: np.ndarray
+            flat log2 target and prediction intensities of all spectra
+        offsets: np.ndarray
+            start of every spectrum in the flat arrays, followed by the total
+            length; peaks of spectrum i are true[offsets[i]:offsets[i + 1]]
+        epsilon: float
+            lower bound of the squared l2 norm, as in spectral_angle
+
+        output:
+        dictionary with PCC and SA arrays, equal to ms2pip_pearson and
+        spectral_angle per spectrum
+        """
+        true = np.asarray(true, dtype=np.float64)
+        pred = np.asarray(pred, dtype=np.float64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.diff(offsets)
+        pcc = np.full(len(lengths), np.nan)
+        sa = np.full(len(lengths), np.nan)
+        non_empty = lengths > 0
+        if not non_empty.any():
+            return {"PCC": pcc, "SA": sa}
+
+        starts = offsets[:-1][non_empty]
+        n = lengths[non_empty]
+
+        def segment_sum(x):
+            return np.add.reduceat(x, starts)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            true_centered = true - np.repeat(segment_sum(true) / n, n)
+            pred_centered = pred - np.repeat(segment_sum(pred) / n, n)
+            pcc[non_empty] = segment_sum(true_centered * pred_centered) / np.sqrt(
+                segment_sum(true_centered ** 2) * segment_sum(pred_centered ** 2)
+            )
+
+            true_de_log = 2 ** true - 0.001
+            pred_de_log = 2 ** pred - 0.001
+            true_norm = np.sqrt(np.maximum(segment_sum(true_de_log ** 2), epsilon))
+            pred_norm = np.sqrt(np.maximum(segment_sum(pred_de_log ** 2), epsilon))
+            dot = segment_sum(true_de_log * pred_de_log) / (true_norm * pred_norm)
+            sa[non_empty] = 1 - (2 * np.arccos(np.clip(dot, -1, 1)) / np.pi)
+
+        return {"PCC": pcc, "SA": sa}
+
+
+def _write_mgf_spectra(mgf_file, spec_dict, out, usi=False):
+    """Write the spectra of one MGF file present in spec_dict to an open handle"""
+
+    if usi:
+        pattern = re.compile(r"mzspec:(unpublished|PXD[0-9]{6}):(\S*):scan:\d+")
+    else:
+        pattern = re.compile(r"scan(?:\=|\:)(\d+)")
+    group = 0 if usi else 1
+    found = False
+    with open_mgf(mgf_file, "r") as f:
+        for line in f:
+            if line.startswith("TITLE="):
+                match = (pattern.match if usi else pattern.search)(line[6:].strip())
+                scan_id = match.group(group) if match else None
+                if scan_id in spec_dict:
+                    found = True
+                    out.write("BEGIN IONS\n")
+                    out.write("TITLE=" + spec_dict[scan_id] + "\n")
+                    continue
+            elif "END IONS" in line:
+                if found:
+                    out.write(line)
+                    found = False
+            elif found and line[-4:] != "0.0\n":
+                out.write(line)
+
+
+def _extract_mgf_shard(mgf_file, spec_dict, shard, usi=False):
+    """Process pool worker writing the spectra of one MGF file to its own shard"""
+
+    with open(shard, mode="w") as out:
+        _write_mgf_spectra(mgf_file, spec_dict, out, usi=usi)
+
+
+_BEGIN_IONS_PATTERN = re.compile(rb"^BEGIN IONS\r?$", re.MULTILINE)
+_PEAK_PATTERN = re.compile(rb"^[0-9]", re.MULTILINE)
+
+
+def _count_mgf_spectra(mgf_file, peak_counts=False):
+    """
+    Count BEGIN IONS lines (and peak lines) in a memory-mapped MGF file
+
+    Returns a (spectra, bytes, peaks) tuple, peaks is None if not counted.
+    """
+
+    size = os.path.getsize(mgf_file)
+    if size == 0:
+        return 0, 0, 0 if peak_counts else None
+    if mgf_file.endswith((".gz", ".zst")):
+        return _count_compressed_mgf_spectra(mgf_file, size, peak_counts)
+    with open(mgf_file, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = sum(1 for _ in _BEGIN_IONS_PATTERN.finditer(mm))
+            peaks = sum(1 for _ in _PEAK_PATTERN.finditer(mm)) if peak_counts else None
+    return count, size, peaks
+
+
+def _count_compressed_mgf_spectra(mgf_file, size, peak_counts=False, chunk_size=1 << 24):
+    """Count BEGIN IONS lines (and peak lines) in chunks of a decompressed stream"""
+
+    count = 0
+    peaks = 0
+    remainder = b""
+    with open_mgf(mgf_file, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            last_newline = chunk.rfind(b"\n") + 1
+            chunk, remainder = chunk[:last_newline], chunk[last_newline:]
+            count += sum(1 for _ in _BEGIN_IONS_PATTERN.finditer(chunk))
+            if peak_counts:
+                peaks += sum(1 for _ in _PEAK_PATTERN.finditer(chunk))
+    count += sum(1 for _ in _BEGIN_IONS_PATTERN.finditer(remainder))
+    if peak_counts:
+        peaks += sum(1 for _ in _PEAK_PATTERN.finditer(remainder))
+    return count, size, peaks if peak_counts else None
+
+
+class MGFIndex:
+    """
+    Byte-offset index of the spectra in one MGF file
+
+    The index maps spectrum titles, scan numbers and USIs (if the titles are
+    USIs) to the byte offset of the concomitant BEGIN IONS line. It is stored
+    next to the MGF file and rebuilt when the size or mtime of the MGF file
+    changes.
+    """
+
+    index_suffix = ".index"
+
+    def __init__(self, mgf_file) -> None:
+        self.mgf_file = mgf_file
+        self.index_file = mgf_file + self.index_suffix
+        self.titles = dict()
+        self.scans = dict()
+        self.usis = dict()
+        if not self.load():
+            self.build()
+            self.save()
+
+    def _file_signature(self):
+        stat = os.stat(self.mgf_file)
+        return stat.st_size, stat.st_mtime_ns
+
+    def build(self):
+        """Build the index in one pass over the MGF file"""
+
+        self.titles, self.scans, self.usis = dict(), dict(), dict()
+        offset = 0
+        spectrum_offset = None
+        title = None
+        scan = None
+        with open_mgf(self.mgf_file, "rb") as f:
+            for line in f:
+                if line.startswith(b"BEGIN IONS"):
+                    spectrum_offset = offset
+                    title, scan = None, None
+                elif spectrum_offset is not None and line.startswith(b"TITLE="):
+                    title = line[6:].decode().strip()
+                    match = re.search(r"scan(?:\=|\:)(\d+)", title)
+                    if match:
+                        scan = match.group(1)
+                elif spectrum_offset is not None and line.startswith(b"SCANS=") and not scan:
+                    scan = line[6:].decode().strip()
+                elif line.startswith(b"END IONS") and spectrum_offset is not None:
+                    if title is not None:
+                        # duplicated titles keep the last spectrum, like the pyteomics index
+                        self.titles[title] = spectrum_offset
+                        usi = re.match(
+                            r"mzspec:(unpublished|PXD[0-9]{6}):(\S*):scan:\d+", title
+                        )
+                        if usi:
+                            self.usis[usi.group(0)] = spectrum_offset
+                    if scan is not None:
+                        self.scans.setdefault(scan, spectrum_offset)
+                    spectrum_offset = None
+                offset += len(line)
+        self._signature = self._file_signature()
+
+    def save(self):
+        """Write the index to its sidecar file, skip if the folder is read-only"""
+
+        size, mtime = self._signature
+        try:
+            with open(self.index_file, "w") as f:
+                json.dump(
+                    {
+                        "mgf_size": size,
+                        "mgf_mtime": mtime,
+                        "titles": self.titles,
+                        "scans": self.scans,
+                        "usis": self.usis,
+                    },
+                    f,
+                )
+        except OSError:
+            pass
+
+    def load(self):
+        """Load the sidecar index, return False if missing or outdated"""
+
+        if not os.path.isfile(self.index_file):
+            return False
+        try:
+            with open(self.index_file, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        size, mtime = self._file_signature()
+        if index.get("mgf_size") != size or index.get("mgf_mtime") != mtime:
+            return False
+        self.titles = index["titles"]
+        self.scans = index["scans"]
+        self.usis = index["usis"]
+        self._signature = (size, mtime)
+        return True
+
+    def get_offset(self, spectrum_id):
+        """Return the byte offset of a title or USI, None if absent"""
+
+        for mapping in (self.titles, self.usis):
+            if spectrum_id in mapping:
+                return mapping[spectrum_id]
+        return None
+
+    @staticmethod
+    def read_spectrum_text(f, offset):
+        """Read the text of the spectrum starting at offset in an open binary file"""
+
+        if f.seekable():
+            f.seek(offset)
+        else:
+            skip = offset - f.tell()
+            if skip < 0:
+                raise ValueError("Compressed MGF streams can only be read forward")
+            while skip > 0:
+                chunk = f.read(min(skip, 1 << 20))
+                if not chunk:
+                    break
+                skip -= len(chunk)
+        lines = []
+        for line in f:
+            lines.append(line)
+            if line.startswith(b"END IONS"):
+                break
+        return b"".join(lines).decode()
+
+    def read_spectrum(self, spectrum_id):
+        """Parse a single spectrum with pyteomics, None if absent"""
+
+        offset = self.get_offset(spectrum_id)
+        if offset is None:
+            return None
+        with open_mgf(self.mgf_file, "rb") as f:
+            text = self.read_spectrum_text(f, offset)
+        return next(mgf.read(io.StringIO(text), use_index=False))
+
+
+class SpectrumStore:
+    """
+    Columnar, memory-mapped spectrum store converted from MGF files
+
+    The store is a folder with flat m/z and intensity arrays, a per-spectrum
+    offsets array and a metadata table with title, precursor m/z, charge,
+    retention time, scan number and raw file. Peaks of spectrum i are
+    mz[offsets[i]:offsets[i + 1]], slicing does not copy the data.
+    """
+
+    store_info = "store.json"
+
+    def __init__(self, store_path) -> None:
+        if not self.is_store(store_path):
+            raise TypeError("Not a valid spectrum store.")
+        self.store_path = store_path
+        with open(os.path.join(store_path, self.store_info), "r") as f:
+            self.info = json.load(f)
+        self.offsets = self._load_array("offsets.bin", np.int64, self.info["n_spectra"] + 1)
+        self.mz = self._load_array("mz.bin", self.info["mz_dtype"], self.info["n_peaks"])
+        self.intensity = self._load_array(
+            "intensity.bin", self.info["intensity_dtype"], self.info["n_peaks"]
+        )
+        self.metadata = pd.read_csv(
+            os.path.join(store_path, "metadata.csv"),
+            dtype={"title": str, "charge": "Int64", "scan": str, "raw_file": str},
+            keep_default_na=False,
+            na_values={"precursor_mz": [""], "charge": [""], "retention_time": [""]},
+        )
+        self._title_index = None
+        self._scan_index = None
+
+    def _load_array(self, name, dtype, length):
+        if length == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(
+            os.path.join(self.store_path, name), dtype=dtype, mode="r", shape=(length,)
+        )
+
+    @classmethod
+    def is_store(cls, path):
+        return os.path.isdir(path) and os.path.isfile(os.path.join(path, cls.store_info))
+
+    @classmethod
+    def from_mgf(
+        cls, mgf_files, store_path, mz_dtype="float64", intensity_dtype="float32"
+    ):
+        """
+        Convert one or more MGF files into a spectrum store
+
+        Parameters
+        ----------
+        mgf_files: list
+            MGF files to convert, spectra are stored in file order
+        store_path: str
+            folder to write the store to
+        mz_dtype, intensity_dtype: str
+            float32 or float64, default = float64 m/z and float32 intensities
+        """
+
+        os.makedirs(store_path, exist_ok=True)
+        metadata = {
+            "title": [],
+            "precursor_mz": [],
+            "charge": [],
+            "retention_time": [],
+            "scan": [],
+            "raw_file": [],
+        }
+        offsets = [0]
+        with open(os.path.join(store_path, "mz.bin"), "wb") as mz_out, open(
+            os.path.join(store_path, "intensity.bin"), "wb"
+        ) as intensity_out:
+            for mgf_file in tqdm(mgf_files):
+                raw_file = mgf_file.rsplit("/", 1)[-1].split(".", 1)[0]
+                with open_mgf(mgf_file, "r") as f:
+                    for spectrum in mgf.read(f, use_index=False, use_header=f.seekable()):
+                        params = spectrum["params"]
+                        np.asarray(spectrum["m/z array"], dtype=mz_dtype).tofile(mz_out)
+                        np.asarray(spectrum["intensity array"], dtype=intensity_dtype).tofile(
+                            intensity_out
+                        )
+                        offsets.append(offsets[-1] + len(spectrum["m/z array"]))
+                        title = params.get("title", "")
+                        scan = re.search(r"scan(?:\=|\:)(\d+)", title)
+                        metadata["title"].append(title)
+                        metadata["precursor_mz"].append(params.get("pepmass", [np.nan])[0])
+                        metadata["charge"].append(
+                            int(params["charge"][0]) if params.get("charge") else np.nan
+                        )
+                        metadata["retention_time"].append(
+                            float(params.get("rtinseconds", np.nan))
+                        )
+                        metadata["scan"].append(
+                            scan.group(1) if scan else str(params.get("scans", ""))
+                        )
+                        metadata["raw_file"].append(raw_file)
+
+        np.asarray(offsets, dtype=np.int64).tofile(os.path.join(store_path, "offsets.bin"))
+        metadata = pd.DataFrame(metadata)
+        metadata["charge"] = metadata["charge"].astype("Int64")
+        metadata.to_csv(os.path.join(store_path, "metadata.csv"), index=False)
+        with open(os.path.join(store_path, cls.store_info), "w") as f:
+            json.dump(
+                {
+                    "version": 1,
+                    "n_spectra": len(offsets) - 1,
+                    "n_peaks": offsets[-1],
+                    "mz_dtype": np.dtype(mz_dtype).name,
+                    "intensity_dtype": np.dtype(intensity_dtype).name,
+                },
+                f,
+            )
+        return cls(store_path)
+
+    def __len__(self):
+        return self.info["n_spectra"]
+
+    def index_of(self, title):
+        """Return the spectrum index of a title, None if absent"""
+
+        if self._title_index is None:
+            # a duplicated title resolves to its last spectrum, like MGFIndex
+            self._title_index = dict(zip(self.metadata["title"], range(len(self.metadata))))
+        return self._title_index.get(title)
+
+    def index_of_scan(self, raw_file, scan):
+        """Return the spectrum index of a raw file and scan number, None if absent"""
+
+        if self._scan_index is None:
+            # a duplicated scan resolves to its first spectrum, like MGFIndex
+            self._scan_index = self._first_index(
+                zip(self.metadata["raw_file"], self.metadata["scan"])
+            )
+        return self._scan_index.get((raw_file, str(scan)))
+
+    @staticmethod
+    def _first_index(keys):
+        """Map every key to the index of its first occurrence"""
+
+        index = dict()
+        for i, key in enumerate(keys):
+            index.setdefault(key, i)
+        return index
+
+    def get_peaks(self, spectrum):
+        """Return zero-copy m/z and intensity views of a spectrum index or title"""
+
+        if not isinstance(spectrum, (int, np.integer)):
+            spectrum = self.index_of(spectrum)
+            if spectrum is None:
+                raise KeyError("Spectrum not in store.")
+        start, end = self.offsets[spectrum], self.offsets[spectrum + 1]
+        return self.mz[start:end], self.intensity[start:end]
+
+    def get_spectrum(self, spectrum):
+        """Return a spectrum index or title as retrieve_masses dictionary"""
+
+        if not isinstance(spectrum, (int, np.integer)):
+            spectrum = self.index_of(spectrum)
+            if spectrum is None:
+                raise KeyError("Spectrum not in store.")
+        mz, intensity = self.get_peaks(spectrum)
+        row = self.metadata.iloc[spectrum]
+        return {
+            "identifier": row["title"],
+            "precursor_mz": row["precursor_mz"],
+            "precursor_charge": None if pd.isna(row["charge"]) else Charge(row["charge"]),
+            "mz": mz,
+            "intensity": intensity,
+            "retention_time": row["retention_time"],
+        }
+
+    def __getitem__(self, spectrum):
+        return self.get_spectrum(spectrum)
+
+
 class MascotGenericFormat(FileHandeling):
     """Methods for MGF files"""
 
-    def __init__(self, mgf_folder) -> None:
+    def __init__(self, mgf_folder, manifest=None) -> None:
         super().__init__()
-        self.retrieve_files(mgf_folder, file_extension="mgf")
+        if SpectrumStore.is_store(mgf_folder):
+            self.store = SpectrumStore(mgf_folder)
+        else:
+            self.store = None
+            self.retrieve_files(mgf_folder, file_extension=MGF_EXTENSIONS)
+            if manifest:
+                self.check_manifest(manifest)
+        self._indices = dict()
+
+    def get_index(self, mgf_file) -> MGFIndex:
+        """Return the (cached) byte-offset index of an MGF file"""
+
+        if mgf_file not in self._indices:
+            self._indices[mgf_file] = MGFIndex(mgf_file)
+        return self._indices[mgf_file]
+
+    def _locate_spectrum(self, spectrum_id):
+        """Find the MGF file and byte offset of a spectrum title or USI"""
+
+        usi = re.match(r"mzspec:(unpublished|PXD[0-9]{6}):(\S*):scan:(\d+)", spectrum_id)
+        for mgf_file in self.filelist:
+            index = self.get_index(mgf_file)
+            offset = index.get_offset(spectrum_id)
+            if offset is not None:
+                return mgf_file, offset
+        if usi:
+            raw_file, scan = usi.group(2), usi.group(3)
+            for mgf_file in self.filelist:
+                if mgf_file.rsplit("/", 1)[-1].split(".", 1)[0] == raw_file:
+                    offset = self.get_index(mgf_file).scans.get(scan)
+                    if offset is not None:
+                        return mgf_file, offset
+        return None, None
+
+    def _locate_store_spectrum(self, spectrum_id):
+        """Find the spectrum index of a title or USI in the spectrum store"""
+
+        index = self.store.index_of(spectrum_id)
+        if index is None:
+            usi = re.match(
+                r"mzspec:(unpublished|PXD[0-9]{6}):(\S*):scan:(\d+)", spectrum_id
+            )
+            if usi:
+                index = self.store.index_of_scan(usi.group(2), usi.group(3))
+        return index
+
+    @staticmethod
+    def _spectrum_to_dict(spectrum):
+        """Convert a pyteomics spectrum to the retrieve_masses dictionary"""
+
+        return {
+            "identifier": spectrum["params"]["title"],
+            "precursor_mz": spectrum["params"]["pepmass"][0],
+            "precursor_charge": spectrum["params"]["charge"][0],
+            "mz": spectrum["m/z array"],
+            "intensity": spectrum["intensity array"],
+            "retention_time": float(spectrum["params"]["rtinseconds"]),
+        }
 
-    def count_spectra(self) -> pd.DataFrame:
-        """Get spectra count from mgf files"""
+    def count_spectra(
+        self, processes=1, file_sizes=False, peak_counts=False
+    ) -> pd.DataFrame:
+        """
+        Get spectra count from mgf files
+
+        Parameters
+        ----------
+        processes: int
+            number of worker processes, default = 1
+        file_sizes: bool
+            add the file size in bytes per MGF file, default = False
+        peak_counts: bool
+            add the number of peaks per MGF file, default = False
+        """
         counts = {
             "raw file": [],
             "spectra" : []
         }
+        if file_sizes:
+            counts["bytes"] = []
+        if peak_counts:
+            counts["peaks"] = []
+        if self.store is not None:
+            return self._count_store_spectra(counts)
         if not self.filelist:
             print("No files listed")
 
-        total = 0
-        for mgf_file_path in tqdm(self.filelist):
-            count = 0
-            with open(mgf_file_path, "r") as f:
-                for line in f:
-                    if line.rstrip("\n") == "BEGIN IONS":
-                        count += 1
-            filename = mgf_file_path.rsplit("/", 1)[1].rsplit(".",1)[0]
-            total += count
+        cached = dict()
+        if self.manifest is not None:
+            for mgf_file_path in self.file_status["unchanged"]:
+                result = self.manifest.get_result(mgf_file_path, "count_spectra")
+                if result is not None and (not peak_counts or result[2] is not None):
+                    cached[mgf_file_path] = tuple(result)
+        to_count = [f for f in self.filelist if f not in cached]
+
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(
+                    tqdm(
+                        executor.map(
+                            _count_mgf_spectra,
+                            to_count,
+                            [peak_counts] * len(to_count),
+                        ),
+                        total=len(to_count),
+                    )
+                )
+        else:
+            results = [
+                _count_mgf_spectra(mgf_file_path, peak_counts)
+                for mgf_file_path in tqdm(to_count)
+            ]
+        cached.update(zip(to_count, results))
+        if self.manifest is not None:
+            for mgf_file_path, result in zip(to_count, results):
+                self.manifest.set_result(mgf_file_path, "count_spectra", list(result))
+            self.manifest.save()
+        results = [cached[mgf_file_path] for mgf_file_path in self.filelist]
+
+        for mgf_file_path, (count, size, peaks) in zip(self.filelist, results):
+            filename = _get_mgf_stem(mgf_file_path).rsplit(".",1)[0]
             counts["raw file"].append(filename)
             counts["spectra"].append(count)
+            if file_sizes:
+                counts["bytes"].append(size)
+            if peak_counts:
+                counts["peaks"].append(peaks)
         counts["raw file"].append("total")
-        counts["spectra"].append(total)
+        for column in counts:
+            if column != "raw file":
+                counts[column].append(sum(counts[column]))
 
         return pd.DataFrame(counts)
 
+    def _count_store_spectra(self, counts):
+        """Get spectra count per raw file from the spectrum store metadata"""
+
+        peaks = np.diff(self.store.offsets)
+        per_raw_file = pd.DataFrame(
+            {"raw_file": self.store.metadata["raw_file"], "peaks": peaks}
+        ).groupby("raw_file", sort=False)["peaks"].agg(["size", "sum"])
+        peak_bytes = self.store.mz.itemsize + self.store.intensity.itemsize
+        counts["raw file"].extend(per_raw_file.index.tolist() + ["total"])
+        counts["spectra"].extend(per_raw_file["size"].tolist() + [len(self.store)])
+        if "bytes" in counts:
+            counts["bytes"].extend(
+                (per_raw_file["sum"] * peak_bytes).tolist() + [int(peaks.sum()) * peak_bytes]
+            )
+        if "peaks" in counts:
+            counts["peaks"].extend(per_raw_file["sum"].tolist() + [int(peaks.sum())])
+        return pd.DataFrame(counts)
+
     def get_spec_id(self):
+        if self.store is not None:
+            return self.store.metadata["title"].tolist()
         spec_list = []
         for mgf_file in self.filelist:
-            with open(mgf_file, "r") as f:
+            with open_mgf(mgf_file, "r") as f:
                 for line in f:
                     if "TITLE" in line:
                         spec_list.append(line[6:].strip())
+        return spec_list
+
+    def _get_spec_dicts(self, peprec_in, spec_id_name, usi=False):
+        """Map scan numbers or USIs to output titles per raw file with one groupby"""
 
-    def scan_mgf(self, peprec_in, spec_id_name, outname="scan_mgf_result.mgf", usi=False):
+        if usi:
+            keys = peprec_in["spec_id"].str.extract(
+                r"(mzspec:(?:unpublished|PXD[0-9]{6}):\S*:scan:\d+)", expand=False
+            )
+        else:
+            keys = peprec_in["spec_id"].str.extract(r"scan(?:\=|\:)(\d+)", expand=False)
+        spec_dicts = dict()
+        for raw_file, group in pd.DataFrame(
+            {"key": keys, "title": peprec_in[spec_id_name], "raw_file": peprec_in["Raw file"]}
+        ).groupby("raw_file", sort=False):
+            spec_dicts[raw_file] = dict(zip(group["key"], group["title"]))
+        return spec_dicts
+
+    def scan_mgf(
+        self, peprec_in, spec_id_name, outname="scan_mgf_result.mgf", usi=False, processes=1
+    ):
+        """
+        Gather the spectra of a peprec from the MGF files into one MGF file
+
+        Parameters
+        ----------
+        peprec_in: pd.DataFrame
+            peprec with spec_id and Raw file columns
+        spec_id_name: str
+            peprec column used as TITLE in the output MGF
+        outname: str
+            name of the output MGF file
+        usi: bool
+            match spectra on USI titles instead of scan numbers, default = False
+        processes: int
+            number of worker processes, each MGF file is extracted into its own
+            shard and the shards are concatenated in file order, default = 1
+        """
+
+        spec_dicts = self._get_spec_dicts(peprec_in, spec_id_name, usi=usi)
+        if self.store is not None:
+            self._write_store_spectra(spec_dicts, outname, usi=usi)
+            return
+        jobs = [
+            (mgf_file, spec_dicts[raw_file])
+            for mgf_file, raw_file in (
+                (f, f.rsplit("/", 1)[1].split(".", 1)[0]) for f in self.filelist
+            )
+            if raw_file in spec_dicts
+        ]
 
+        if processes <= 1:
+            with open(outname, mode="w") as out:
+                for mgf_file, spec_dict in tqdm(jobs):
+                    _write_mgf_spectra(mgf_file, spec_dict, out, usi=usi)
+            return
+
+        shard_folder = tempfile.mkdtemp(
+            prefix="scan_mgf_", dir=os.path.dirname(os.path.abspath(outname))
+        )
+        try:
+            shards = [
+                os.path.join(shard_folder, f"{i}.mgf") for i in range(len(jobs))
+            ]
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [
+                    executor.submit(_extract_mgf_shard, mgf_file, spec_dict, shard, usi)
+                    for (mgf_file, spec_dict), shard in zip(jobs, shards)
+                ]
+                for future in tqdm(futures):
+                    future.result()
+            with open(outname, mode="wb") as out:
+                for shard in shards:
+                    with open(shard, "rb") as f:
+                        shutil.copyfileobj(f, out)
+        finally:
+            shutil.rmtree(shard_folder, ignore_errors=True)
+
+    def _write_store_spectra(self, spec_dicts, outname, usi=False):
+        """Write the spectra in spec_dicts from the spectrum store to an MGF file"""
+
+        metadata = self.store.metadata
+        if usi:
+            keys = metadata["title"].str.extract(
+                r"(mzspec:(?:unpublished|PXD[0-9]{6}):\S*:scan:\d+)", expand=False
+            )
+        else:
+            keys = metadata["scan"]
         with open(outname, mode="w") as out:
-            for mgf_file in tqdm(self.filelist):
-                if not usi:
-                    spec_dict = dict(
-                        (
-                            re.search(r"scan(?:\=|\:)(\d+)", v).group(1),
-                            peprec_in[spec_id_name][k],
+            for i, (key, raw_file) in enumerate(tqdm(zip(keys, metadata["raw_file"]), total=len(keys))):
+                spec_dict = spec_dicts.get(raw_file)
+                if not spec_dict or key not in spec_dict:
+                    continue
+                row = metadata.iloc[i]
+                mz, intensity = self.store.get_peaks(i)
+                out.write("BEGIN IONS\n")
+                out.write("TITLE=" + spec_dict[key] + "\n")
+                out.write(f"PEPMASS={row['precursor_mz']}\n")
+                if not pd.isna(row["charge"]):
+                    out.write(f"CHARGE={int(row['charge'])}+\n")
+                if not pd.isna(row["retention_time"]):
+                    out.write(f"RTINSECONDS={row['retention_time']}\n")
+                for peak_mz, peak_intensity in zip(mz, intensity):
+                    if peak_intensity != 0:
+                        out.write(
+                            np.format_float_positional(peak_mz, trim="0")
+                            + " "
+                            + np.format_float_positional(peak_intensity, trim="0")
+                            + "\n"
                         )
-                        for k, v in peprec_in[
-                            (
-                                peprec_in["Raw file"]
-                                == mgf_file.rsplit("/", 1)[1].split(".", 1)[0]
-                            )
-                        ]["spec_id"]
-                        .to_dict()
-                        .items()
-                    )
-                if usi:
-                    spec_dict = dict(
-                        (
-                            re.search(r"mzspec:(unpublished|PXD[0-9]{6}):(\S*):scan:\d+", v).group(0),
-                            peprec_in[spec_id_name][k],
+                out.write("END IONS\n")
+
+    def retrieve_spectra(self, ids, as_arrays=False):
+        """
+        Retrieve many spectra with one sequential pass per MGF file
+
+        Parameters
+        ----------
+        ids: list or pd.Series
+            spectrum titles or USIs
+        as_arrays: bool
+            yield (identifier, mz, intensity) tuples of NumPy arrays instead of
+            retrieve_masses-style dictionaries, default = False
+
+        Spectra are yielded grouped per MGF file in file order, identifiers
+        that are not found are skipped.
+        """
+
+        if self.store is not None:
+            indices = set()
+            for spectrum_id in pd.unique(pd.Series(ids, dtype=object)):
+                index = self._locate_store_spectrum(spectrum_id)
+                if index is not None:
+                    indices.add(index)
+            for index in sorted(indices):
+                spectrum = self.store.get_spectrum(index)
+                if as_arrays:
+                    yield spectrum["identifier"], spectrum["mz"], spectrum["intensity"]
+                else:
+                    yield spectrum
+            return
+
+        offsets_per_file = dict()
+        for spectrum_id in pd.unique(pd.Series(ids, dtype=object)):
+            mgf_file, offset = self._locate_spectrum(spectrum_id)
+            if mgf_file is not None:
+                offsets_per_file.setdefault(mgf_file, set()).add(offset)
+
+        for mgf_file in self.filelist:
+            if mgf_file not in offsets_per_file:
+                continue
+            with open_mgf(mgf_file, "rb") as f:
+                for offset in sorted(offsets_per_file[mgf_file]):
+                    text = MGFIndex.read_spectrum_text(f, offset)
+                    spectrum = next(mgf.read(io.StringIO(text), use_index=False))
+                    if as_arrays:
+                        yield (
+                            spectrum["params"]["title"],
+                            np.asarray(spectrum["m/z array"], dtype=np.float64),
+                            np.asarray(spectrum["intensity array"], dtype=np.float64),
                         )
-                        for k, v in peprec_in[
-                            (
-                                peprec_in["Raw file"]
-                                == mgf_file.rsplit("/", 1)[1].split(".", 1)[0]
-                            )
-                        ]["spec_id"]
-                        .to_dict()
-                        .items()
-                    )
-                found = False
-                with open(mgf_file, "r") as f:
-                    for line in f:
-                        if "TITLE" in line:
-                            if not usi:
-                                match = re.search(r"scan(?:\=|\:)(\d+)", line[6:].strip())
-                                scan_id = match.group(1)
-                            elif usi:
-                                match = re.match(r"mzspec:(unpublished|PXD[0-9]{6}):(\S*):scan:\d+", line[6:].strip())
-                                scan_id = match.group(0)
-
-                            if scan_id in spec_dict:
-                                found = True
-                                out.write("BEGIN IONS\n")
-                                out.write("TITLE=" + spec_dict[scan_id] + "\n")
-                                continue
-                        elif "END IONS" in line:
-                            if found:
-                                out.write(line)
-                                found = False
-                        elif found and line[-4:] != "0.0\n":
-                            out.write(line)
+                    else:
+                        yield self._spectrum_to_dict(spectrum)
 
     def retrieve_masses(self, psm_id):
-        spectrum_dict = dict()
-        found = False
-        for mgf_file in self.filelist:
-            for spectrum in mgf.read(mgf_file):
-                if psm_id == spectrum["params"]["title"]:
-                    spectrum_dict["identifier"] = spectrum["params"]["title"]
-                    spectrum_dict["precursor_mz"] = spectrum["params"]["pepmass"][0]
-                    spectrum_dict["precursor_charge"] = spectrum["params"]["charge"][0]
-                    spectrum_dict["mz"] = spectrum["m/z array"]
-                    spectrum_dict["intensity"] = spectrum["intensity array"]
-                    spectrum_dict["retention_time"] = float(
-                        spectrum["params"]["rtinseconds"]
-                    )
-                    found = True
-                    break
-            if found:
-                break
-        return spectrum_dict
+        """Retrieve a single spectrum by title or USI through the MGF indices"""
+
+        return next(self.retrieve_spectra([psm_id]), dict())
 
     def check_mgf_file_presence(self, raw_file_list: list):
         "Check if all mgf files are present in your folder, given a raw file list"
 
         missing_mgf_files = []
 
-        mgf_files = [x.rsplit("/", 1)[1].split(".", 1)[0] for x in self.filelist]
+        if self.store is not None:
+            mgf_files = set(self.store.metadata["raw_file"])
+        else:
+            mgf_files = [x.rsplit("/", 1)[1].split(".", 1)[0] for x in self.filelist]
         for raw_file in raw_file_list:
             if raw_file in mgf_files:
                 pass
@@ -221,13 +1114,41 @@ class MascotGenericFormat(FileHandeling):
         return missing_mgf_files
 
 
+def encode_precursor_keys(modified_sequence, charge):
+    """
+    Stable int64 key per (modified sequence, charge)
+
+    The key is a 64-bit hash, so the same precursor gets the same key in every
+    file, process and run. PrositLib and PeptideRecord are joined on it.
+    """
+
+    precursors = pd.DataFrame(
+        {
+            "modified_sequence": np.asarray(modified_sequence, dtype=object),
+            "charge": np.asarray(charge, dtype=np.int64),
+        }
+    )
+    return pd.util.hash_pandas_object(precursors, index=False).to_numpy().view(np.int64)
+
+
 class PeptideRecord(FileHandeling):
     """Methods for peprec files"""
 
-    def __init__(self, peprec) -> None:
+    inverse_modification_map = {
+        "Oxidation" : "ox",
+        "Phospho" : "ph",
+        "Acetyl" : "ac",
+        "Carbamidomethyl" : "ca",
+        "Cysteinyl" : "cy",
+    }
+
+    def __init__(self, peprec, raw_files=None) -> None:
         super().__init__()
+        self._modification_index = None
+        self._modification_index_key = None
         if isinstance(peprec, str):
-            self.peprec = pd.read_table(peprec, sep=" ")
+            peprec = peprec.rstrip("/")
+            self.peprec = read_peprec(peprec, raw_files=raw_files)
             if "/" in peprec:
                 self.peprec_name = peprec.rsplit("/", 1)[1].split(".", 1)[0]
             else:
@@ -236,118 +1157,277 @@ class PeptideRecord(FileHandeling):
             self.peprec = peprec
             self.peprec_name = "peprec"
 
+    precursor_columns = ["peptide", "modifications", "charge"]
+
     def select_unique_peptide(self):
-        self.peprec.sort_values("psm_score", ascending=False)
-        self.peprec.drop_duplicates(
-            ["peptide", "modifications", "charge"], keep="first", inplace=True
-        )
+        """Keep the best-scoring PSM per precursor, in peprec order"""
+
+        order = np.argsort(-self.peprec["psm_score"].to_numpy(dtype=np.float64), kind="stable")
+        best = ~self.peprec.iloc[order].duplicated(self.precursor_columns, keep="first").to_numpy()
+        self.peprec = self.peprec.iloc[np.sort(order[best])]
+
+    @classmethod
+    def _precursor_keys(cls, peprec):
+        """64-bit hash of (peptide, modifications, charge) per PSM"""
+
+        return pd.util.hash_pandas_object(
+            pd.DataFrame(
+                {
+                    "peptide": peprec["peptide"].astype(str),
+                    "modifications": peprec["modifications"].astype(str),
+                    "charge": peprec["charge"].astype(np.int64),
+                }
+            ),
+            index=False,
+        ).to_numpy()
+
+    @classmethod
+    def from_best_psms(cls, filelist, chunksize=1000000):
+        """
+        Read peprec files chunk by chunk and keep the best-scoring PSM per precursor
+
+        Precursors (peptide, modifications, charge) are hashed into a 64-bit
+        key, only the best row per key is kept in memory. Equal scores keep
+        the first PSM in file order. Columns missing from some files are
+        filled with NaN.
+
+        Parameters
+        ----------
+        filelist: list
+            text or binary (Parquet/Feather) peprec files
+        chunksize: int
+            number of rows read at once
+        """
+
+        if not filelist:
+            raise ValueError("No peprec files given.")
+        best = None
+        for filename in tqdm(filelist):
+            for chunk in iter_peprec(filename, chunksize=chunksize):
+                chunk = chunk.assign(_precursor_key=cls._precursor_keys(chunk))
+                chunk = chunk.sort_values("psm_score", ascending=False, kind="stable")
+                chunk = chunk.drop_duplicates("_precursor_key", keep="first")
+                if best is not None:
+                    chunk = pd.concat([best, chunk], ignore_index=True, join="outer")
+                    chunk = chunk.sort_values("psm_score", ascending=False, kind="stable")
+                    chunk = chunk.drop_duplicates("_precursor_key", keep="first")
+                best = chunk
+        peprec = cls(best.drop(columns="_precursor_key").reset_index(drop=True))
+        return peprec
 
     def select_duplicates(self):
         duplicates = self.peprec.duplicated(["peptide", "modifications", "charge"], keep=False)
         self.peprec = self.peprec[duplicates]
 
+    def _build_modification_index(self):
+        """
+        Explode the peprec modifications into one row per modification
+
+        output:
+        dataframe with psm (row position in the peprec), location,
+        modification, residue (amino acid, N-term or C-term) and
+        suffix_residue (the amino acid used as modification suffix)
+        """
+        modifications = self.peprec["modifications"]
+        modified = (
+            modifications.notna() & (modifications != "-") & (modifications != "")
+        ).to_numpy()
+        tokens = modifications[modified].str.split("|")
+        tokens.index = np.flatnonzero(modified)
+        tokens = tokens.explode()
+        if len(tokens) % 2 or (tokens.groupby(level=0).size() % 2).any():
+            raise ValueError("Modifications should be location|name pairs")
+
+        psm = tokens.index.to_numpy()[0::2]
+        location = tokens.to_numpy()[0::2].astype(np.int64)
+        modification = tokens.to_numpy()[1::2].astype(str)
+
+        peptides = self.peprec["peptide"].fillna("").astype(str)
+        peptide_length = peptides.str.len().to_numpy()
+        peptide_start = np.concatenate([[0], np.cumsum(peptide_length)[:-1]])
+        residues = np.frombuffer("".join(peptides).encode(), dtype="S1")
+        length = peptide_length[psm]
+
+        n_term = location == 0
+        c_term = (location == -1) | (location == length + 1)
+        residue_position = np.clip(location - 1, 0, np.maximum(length - 1, 0))
+        residue = residues[peptide_start[psm] + residue_position].astype(str) if len(psm) else np.empty(0, dtype=str)
+        suffix_position = np.where(c_term, length - 1, np.where(n_term, 0, residue_position))
+        suffix_residue = residues[peptide_start[psm] + suffix_position].astype(str) if len(psm) else np.empty(0, dtype=str)
+
+        return pd.DataFrame(
+            {
+                "psm": psm,
+                "location": location,
+                "modification": modification,
+                "residue": np.where(n_term, "N-term", np.where(c_term, "C-term", residue)),
+                "suffix_residue": suffix_residue,
+            }
+        )
+
+    @property
+    def modification_index(self):
+        """Long-format modification index, rebuilt when peptides or modifications change"""
+
+        # per-row hashes in row order, the index stores row positions
+        key = pd.util.hash_pandas_object(
+            self.peprec[["peptide", "modifications"]], index=False
+        ).to_numpy()
+        if self._modification_index is None or not np.array_equal(
+            key, self._modification_index_key
+        ):
+            self._modification_index = self._build_modification_index()
+            self._modification_index_key = key
+        return self._modification_index
+
     def _get_double_modifications(self):
-        unique_aa_modifications = dict()
-        self._suffix_list = []
-        for tuple in self.peprec.itertuples():
-            s = re.findall(r"[\d]*.\|[A-Za-z0-9]*", tuple.modifications)
-            for match in s:
-                loc = int(re.search(r"(\d+)", match).group(0))
-                modification = re.search(r"[A-Za-z0-9]*$", match).group()
-                if loc == 0:
-                    aa = "N-term"
-                elif loc == len(tuple.peptide) + 1:
-                    aa = "C-term"
-                else:
-                    aa = tuple.peptide[loc - 1]
-
-                if (
-                    modification in unique_aa_modifications.keys()
-                    and aa == unique_aa_modifications[modification]
-                ):
-                    pass
-                elif (
-                    modification in unique_aa_modifications.keys()
-                    and aa != unique_aa_modifications[modification]
-                ):
-                    if modification in self._suffix_list:
-                        pass
-                    elif modification not in self._suffix_list:
-                        self._suffix_list.append(modification)
-                else:
-                    unique_aa_modifications[modification] = aa
+        index = self.modification_index
+        residues_per_modification = index.groupby("modification", sort=False)["residue"].nunique()
+        self._suffix_list = residues_per_modification[residues_per_modification > 1].index.tolist()
 
     def add_modification_suffix(self):
         self._get_double_modifications()
 
-        def sequence_location_fix(location: str):
-            location = int(location)
-            if location > 0:
-                return location - 1
-            else:
-                return location
-
         if not self._suffix_list:
             pass
         else:
             print(self._suffix_list)
-            modified_peprec = self.peprec[
-                (self.peprec["modifications"] != "-")
-                & (self.peprec["modifications"] != "")
-                & (~self.peprec["modifications"].isna())
-            ]
-            peptide_modifications = []
-            for tuple in modified_peprec.itertuples(name="peprec", index=False):
-                new_mods = []
-                sequence = tuple.peptide
-                loc = tuple.modifications.split("|")[::2]
-                mod = tuple.modifications.split("|")[1::2]
-                for loc, mod in zip(loc, mod):
-                    if mod in self._suffix_list:
-                        new_mods.append(
-                            f"{loc}|{mod + sequence[sequence_location_fix(loc)]}"
-                        )
-                    else:
-                        new_mods.append(f"{loc}|{mod}")
+            index = self.modification_index
+            modification = index["modification"].where(
+                ~index["modification"].isin(self._suffix_list),
+                index["modification"] + index["suffix_residue"],
+            )
+            peptide_modifications = (
+                (index["location"].astype(str) + "|" + modification)
+                .groupby(index["psm"].to_numpy(), sort=False)
+                .agg("|".join)
+            )
+            modifications = self.peprec["modifications"].to_numpy(dtype=object, copy=True)
+            modifications[peptide_modifications.index.to_numpy()] = peptide_modifications.to_numpy()
 
-                peptide_modifications.append("|".join(new_mods))
-            modified_peprec = modified_peprec.drop("modifications", axis=1)
+            peprec = self.peprec.copy()
+            peprec["modifications"] = modifications
+            self.peprec = peprec
 
-            modified_peprec.insert(2, "modifications", peptide_modifications)
-            peprec = pd.concat(
-                [
-                    modified_peprec,
-                    self.peprec[
-                        ~(self.peprec["modifications"] != "-")
-                        & (self.peprec["modifications"] != "")
-                        & (~self.peprec["modifications"].isna())
-                    ],
-                ]
-            ).sort_index()
+    @staticmethod
+    def _grouped_qvalues(scores, is_decoy, groups):
+        """
+        Target-decoy q-values per group for arrays sorted on group and descending score
 
-            self.peprec = peprec
+        Equal to pyteomics target_decoy.qvalues with formula=1 per group:
+        equal scores get equal q-values and q-values are monotonic.
+        """
+        n = len(scores)
+        if n == 0:
+            return np.empty(0)
+        group_start = np.ones(n, dtype=bool)
+        group_start[1:] = groups[1:] != groups[:-1]
+        group_id = np.cumsum(group_start) - 1
+        start_position = np.flatnonzero(group_start)
+
+        decoys = np.cumsum(is_decoy, dtype=np.float64)
+        decoys -= (decoys - is_decoy)[start_position][group_id]
+        psms = np.arange(1, n + 1, dtype=np.float64) - start_position[group_id]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            q = decoys / (psms - decoys)
+
+        tie_start = group_start.copy()
+        tie_start[1:] |= scores[1:] != scores[:-1]
+        tie_id = np.cumsum(tie_start) - 1
+        tie_end = np.flatnonzero(np.append(tie_start[1:], True))
+        tie_q = (
+            pd.Series(q[tie_end][::-1])
+            .groupby(groups[tie_end][::-1])
+            .cummin()
+            .to_numpy()[::-1]
+        )
+        return tie_q[tie_id]
 
     def calculate_qvalues(self):
-        runs = self.peprec["Raw file"].unique()
-        qvalues_list = []
-        for run in runs:
-            subset = pd.DataFrame(
-                target_decoy.qvalues(
-                    self.peprec.loc[self.peprec["Raw file"] == run],
-                    is_decoy=self.peprec["Label"] == -1,
-                    key="psm_score",
-                    reverse=True,
-                    formula=1,
-                    full_output=True,
-                )
+        """
+        Calculate target-decoy q-values per run in one sorted pass
+
+        output:
+        q-values as pd.Series aligned to the peprec index, also stored in
+        self.qvalues
+        """
+        runs, _ = pd.factorize(self.peprec["Raw file"])
+        scores = self.peprec["psm_score"].to_numpy(dtype=np.float64)
+        is_decoy = (self.peprec["Label"] == -1).to_numpy(dtype=np.float64)
+
+        order = np.lexsort((-scores, runs))
+        qvalues = np.full(len(order), np.nan)
+        qvalues[order] = self._grouped_qvalues(scores[order], is_decoy[order], runs[order])
+        qvalues[runs == -1] = np.nan
+        self.qvalues = pd.Series(qvalues, index=self.peprec.index, name="q")
+        return self.qvalues
+
+    def calculate_multilevel_qvalues(self):
+        """
+        Calculate PSM, run, peptide and precursor level q-values in one pass
+
+        PSMs are sorted once on descending score. Peptide (peptide and
+        modifications) and precursor (peptide, modifications and charge)
+        q-values are calculated on the best-scoring PSM of every integer
+        encoded peptide or precursor and mapped back to all its PSMs.
+
+        output:
+        adds psm_qvalue, run_qvalue, peptide_qvalue and precursor_qvalue
+        columns to the peprec
+        """
+        scores = self.peprec["psm_score"].to_numpy(dtype=np.float64)
+        is_decoy = (self.peprec["Label"] == -1).to_numpy(dtype=np.float64)
+        order = np.argsort(-scores, kind="stable")
+        sorted_scores = scores[order]
+        sorted_is_decoy = is_decoy[order]
+        n = len(order)
+
+        qvalues = dict()
+        psm_q = np.empty(n)
+        psm_q[order] = self._grouped_qvalues(sorted_scores, sorted_is_decoy, np.zeros(n, dtype=np.int64))
+        qvalues["psm_qvalue"] = psm_q
+
+        runs, _ = pd.factorize(self.peprec["Raw file"])
+        run_order = np.argsort(runs[order], kind="stable")
+        run_q = np.empty(n)
+        run_q[order[run_order]] = self._grouped_qvalues(
+            sorted_scores[run_order], sorted_is_decoy[run_order], runs[order][run_order]
+        )
+        run_q[runs == -1] = np.nan
+        qvalues["run_qvalue"] = run_q
+
+        for level, key_columns in (
+            ("peptide_qvalue", ["peptide", "modifications"]),
+            ("precursor_qvalue", ["peptide", "modifications", "charge"]),
+        ):
+            keys = self.peprec.groupby(key_columns, sort=False, dropna=False).ngroup().to_numpy()
+            best = ~pd.Series(keys[order]).duplicated().to_numpy()
+            best_q = self._grouped_qvalues(
+                sorted_scores[best], sorted_is_decoy[best], np.zeros(best.sum(), dtype=np.int64)
             )
-            qvalues_list.append(subset)
-        self.qvalues = pd.concat(qvalues_list)
+            key_q = np.empty(keys.max() + 1 if n else 0)
+            key_q[keys[order][best]] = best_q
+            qvalues[level] = key_q[keys]
+
+        for column, values in qvalues.items():
+            self.peprec[column] = values
+
+    def filter_peprec_on_qvalue(self, limit=0.01, level="run"):
+        """
+        Filter the peprec on q-value
 
-    def filter_peprec_on_qvalue(self, limit=0.01):
-        self.calculate_qvalues()
-        self.qvalues = self.qvalues.loc[self.qvalues["q"] < limit]
-        self.peprec = self.peprec[self.peprec.isin(self.qvalues)].dropna()
+        level: run (per-run PSM q-values, default), psm (global), peptide or
+        precursor; the last three are kept as peprec columns
+        """
+        if level == "run":
+            self.calculate_qvalues()
+            self.peprec = self.peprec[(self.qvalues < limit).to_numpy()]
+        elif level in ("psm", "peptide", "precursor"):
+            if f"{level}_qvalue" not in self.peprec.columns:
+                self.calculate_multilevel_qvalues()
+            self.peprec = self.peprec[self.peprec[f"{level}_qvalue"] < limit]
+        else:
+            raise ValueError(f"Unknown FDR level '{level}'")
 
     def filter_decoys(self):
         self.peprec = self.peprec.loc[self.peprec.Label == 1]
@@ -386,14 +1466,21 @@ class PeptideRecord(FileHandeling):
         self.peprec.rename(columns={"Raw_file": "Raw file"}, inplace=True)
         self.peprec.insert(0, "USI", usi_list)
 
-    def peprec_to_file(self, filename: str, separator: str):
-        """ Write peprec dataframe to file"""
+    def peprec_to_file(self, filename: str, separator: str, file_format="text"):
+        """
+        Write peprec dataframe to file
 
-        if not os.path.exists(filename + ".peprec"):
-            self.peprec.to_csv(filename + ".peprec", separator, index=False, mode="w")
+        file_format: text (default), or parquet/feather for a filename.peprec.<format>
+        dataset partitioned on Raw file
+        """
+
+        if file_format != "text":
+            write_binary_peprec(self.peprec, f"{filename}.peprec.{file_format}", file_format)
+        elif not os.path.exists(filename + ".peprec"):
+            self.peprec.to_csv(filename + ".peprec", sep=separator, index=False, mode="w")
         elif os.path.exists(filename + ".peprec"):
             self.peprec.to_csv(
-                filename + ".peprec", separator, index=False, header=False, mode="a"
+                filename + ".peprec", sep=separator, index=False, header=False, mode="a"
             )
 
     def to_prosit_csv(self, ce):
@@ -407,6 +1494,34 @@ class PeptideRecord(FileHandeling):
 
         return prosit_csv
 
+    @staticmethod
+    def get_pep_ids(modified_sequence, charge):
+        """Readable precursor identifier written to the id-mapping file: modified_sequence/charge"""
+        return modified_sequence + "/" + charge.astype(str)
+
+    def to_unique_prosit_csv(self, ce):
+        """
+        Convert peprec to a prosit csv with one row per unique precursor
+
+        output:
+        prosit csv without spec_id column and spec_id to pep_id/precursor_key
+        mapping, the mapping can be joined to the prosit library with
+        PrositLib.join_spec_ids
+        """
+
+        prosit_csv = self.to_prosit_csv(ce)
+        precursor_keys = encode_precursor_keys(prosit_csv["modified_sequence"], prosit_csv["precursor_charge"])
+        codes, _ = pd.factorize(precursor_keys)
+        first_occurrence = ~pd.Series(codes).duplicated().to_numpy()
+        unique_csv = prosit_csv[first_occurrence].drop(columns="spec_id").reset_index(drop=True)
+        pep_ids = self.get_pep_ids(unique_csv["modified_sequence"], unique_csv["precursor_charge"]).to_numpy()
+        id_mapping = pd.DataFrame(
+            {"spec_id": prosit_csv["spec_id"], "pep_id": pep_ids[codes], "precursor_key": precursor_keys}
+        )
+        prosit_csv = unique_csv
+
+        return prosit_csv, id_mapping
+
     @staticmethod
     def _get_modified_sequence(sequence_mod_tuple):
         """
@@ -418,13 +1533,7 @@ class PeptideRecord(FileHandeling):
         output:
         modified sequence
         """
-        inverse_modification_map = {
-            "Oxidation" : "ox",
-            "Phospho" : "ph",
-            "Acetyl" : "ac",
-            "Carbamidomethyl" : "ca",
-            "Cysteinyl" : "cy",
-        }
+        inverse_modification_map = PeptideRecord.inverse_modification_map
         seq, peprec_mod = sequence_mod_tuple
         if peprec_mod == "-":
             return seq
@@ -445,12 +1554,194 @@ class PeptideRecord(FileHandeling):
         return seq
 
     def acquire_modified_seq(self):
-        """Combine peptide and modifications column of peprec to modified sequences"""
+        """
+        Combine peptide and modifications column of peprec to modified sequences
+
+        Every unique (peptide, modifications) pair is converted once and mapped
+        back to all PSMs.
+        """
+
+        pairs = self.peprec[["peptide", "modifications"]]
+        codes = pairs.groupby(["peptide", "modifications"], sort=False, dropna=False).ngroup().to_numpy()
+        first_occurrence = ~pd.Series(codes).duplicated().to_numpy()
+        unique_pairs = PeptideRecord(pairs[first_occurrence].reset_index(drop=True))
+        modified_sequences = unique_pairs._build_modified_sequences().to_numpy()[codes]
+
+        return pd.Series(modified_sequences, index=self.peprec.index)
+
+    def _build_modified_sequences(self):
+        """Modified sequence of every PSM, built from the modification index"""
+
+        peptides = self.peprec["peptide"].to_numpy(dtype=object)
+        modified_sequences = peptides.copy()
+        index = self.modification_index
+        if len(index):
+            tags = index["modification"].map(self.inverse_modification_map)
+            if tags.isna().any():
+                raise KeyError(index["modification"][tags.isna()].iloc[0])
+
+            # C-terminal (-1) and unordered modifications follow the sequential
+            # insertion rules of _get_modified_sequence
+            inserted = index[index["modification"] != "Carbamidomethyl"]
+            unordered = inserted.groupby("psm", sort=False)["location"].diff() < 0
+            irregular = np.union1d(
+                index.loc[index["location"] == -1, "psm"].unique(),
+                inserted.loc[unordered, "psm"].unique(),
+            )
+            inserted = inserted[~inserted["psm"].isin(irregular)]
+
+            psm = inserted["psm"].to_numpy()
+            end = inserted["location"].to_numpy()
+            start = inserted.groupby("psm", sort=False)["location"].shift(1, fill_value=0).to_numpy()
+            segments = pd.Series(
+                [
+                    peptide[a:b] + f"({tag})"
+                    for peptide, a, b, tag in zip(
+                        peptides[psm], start, end, tags[inserted.index].to_numpy()
+                    )
+                ],
+                index=psm,
+            )
+            heads = segments.groupby(level=0, sort=False).agg("".join)
+            last_location = inserted.groupby("psm", sort=False)["location"].last()
+            modified_sequences[heads.index.to_numpy()] = [
+                head + peptides[p][last:]
+                for head, p, last in zip(heads.to_numpy(), heads.index, last_location[heads.index].to_numpy())
+            ]
+            for p in irregular:
+                modified_sequences[p] = self._get_modified_sequence(
+                    (peptides[p], self.peprec["modifications"].iloc[p])
+                )
+
+        return pd.Series(modified_sequences, index=self.peprec.index)
+
+
+PRED_AND_EMP_DTYPES = {
+    "spec_id": str,
+    "charge": "int8",
+    "ion": "category",
+    "ionnumber": "int16",
+    "mz": "float64",
+    "target": "float64",
+    "prediction": "float64",
+}
+
+
+def _pred_and_emp_cache_file(pred_and_emp_csv):
+    return str(pred_and_emp_csv) + ".feather"
+
+
+def _build_pred_and_emp_cache(pred_and_emp_csv, cache_file, signature):
+    """Convert a pred_and_emp csv to an uncompressed Feather file tagged with the csv size and mtime"""
+
+    header = pd.read_csv(pred_and_emp_csv, nrows=0).columns
+    column_types = {
+        "spec_id": pa.string(),
+        "charge": pa.int8(),
+        "ion": pa.dictionary(pa.int32(), pa.string()),
+        "ionnumber": pa.int16(),
+        "mz": pa.float64(),
+        "target": pa.float64(),
+        "prediction": pa.float64(),
+    }
+    table = pa_csv.read_csv(
+        pred_and_emp_csv,
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column: column_types[column] for column in header if column in column_types}
+        ),
+    ).unify_dictionaries()
+    table = table.replace_schema_metadata(
+        {"source_size": str(signature[0]), "source_mtime_ns": str(signature[1])}
+    )
+    partial_file = cache_file + ".partial"
+    try:
+        feather.write_feather(table, partial_file, compression="uncompressed")
+        os.replace(partial_file, cache_file)
+    except OSError:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        raise
+
+
+def _read_pred_and_emp_csv(pred_and_emp_csv, columns=None):
+    header = pd.read_csv(pred_and_emp_csv, nrows=0).columns
+    return pd.read_csv(
+        pred_and_emp_csv,
+        usecols=columns,
+        dtype={column: dtype for column, dtype in PRED_AND_EMP_DTYPES.items() if column in header},
+    )[columns or header]
+
+
+def read_pred_and_emp(pred_and_emp_csv, columns=None, cache=True):
+    """
+    Read an ms2pip pred_and_emp csv with compact dtypes
+
+    The first read converts the csv to a <csv>.feather cache next to it, with
+    the ion column categorical. Later reads memory-map the cache and only load
+    the requested columns. The cache is rebuilt when the size or mtime of the
+    csv changes or the cache is corrupt. Without pyarrow, or when the cache cannot be written (e.g. a
+    read-only folder), the csv is read with pd.read_csv.
+
+    Parameters
+    ----------
+    pred_and_emp_csv: str
+        ms2pip pred_and_emp csv
+    columns: list
+        only read these columns, default = all columns
+    cache: bool
+        create and use the Feather cache, default = True
+    """
+
+    if pa is None or not cache:
+        return _read_pred_and_emp_csv(pred_and_emp_csv, columns)
+
+    stat = os.stat(pred_and_emp_csv)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    cache_file = _pred_and_emp_cache_file(pred_and_emp_csv)
+    if os.path.exists(cache_file):
+        try:
+            with pa.memory_map(cache_file) as source:
+                metadata = pa.ipc.open_file(source).schema.metadata or {}
+            cached_signature = (
+                int(metadata.get(b"source_size", -1)),
+                int(metadata.get(b"source_mtime_ns", -1)),
+            )
+        except (OSError, pa.ArrowInvalid):
+            # truncated or corrupt cache, rebuild it
+            cached_signature = None
+        if cached_signature != signature:
+            try:
+                os.remove(cache_file)
+            except OSError:
+                return _read_pred_and_emp_csv(pred_and_emp_csv, columns)
+    if not os.path.exists(cache_file):
+        try:
+            _build_pred_and_emp_cache(pred_and_emp_csv, cache_file, signature)
+        except OSError:
+            return _read_pred_and_emp_csv(pred_and_emp_csv, columns)
+
+    return feather.read_table(cache_file, columns=columns, memory_map=True).to_pandas()
+
 
-        loc_mod_tuples = pd.Series(zip(self.peprec["peptide"], self.peprec["modifications"]))
-        modified_sequences = loc_mod_tuples.apply(self._get_modified_sequence)
+_shared_pred_emp_csv = None
 
-        return modified_sequences
+
+def _init_pred_and_emp_worker(pred_emp_csv):
+    """Keep the ms2pip pred_and_emp table in the worker, it is sent once per worker instead of once per task"""
+    global _shared_pred_emp_csv
+    _shared_pred_emp_csv = pred_emp_csv
+
+
+def _process_ce_library(prosit_library, pred_emp_csv=None):
+    """Write the pred_and_emp csv of one CE library and return its correlations"""
+
+    if pred_emp_csv is None:
+        pred_emp_csv = _shared_pred_emp_csv
+    prositlib = PrositLib(prosit_library)
+    prosit_pred_emp = prositlib._create_pred_and_emp(pred_emp_csv)
+    prosit_pred_emp.to_csv(prositlib._pred_and_emp_filename(), index=False, header=True)
+
+    return PrositLib(prosit_pred_emp).calculate_prediction_correlation(["spec_id", "ce"], include_lists=False)
 
 
 class PrositLib(FileHandeling):
@@ -458,10 +1749,23 @@ class PrositLib(FileHandeling):
 
     def __init__(self, myprositlib) -> None:
         super().__init__()
+        self._prositlib = None
         if isinstance(myprositlib, str):
-            self.prositlib = pd.read_csv(myprositlib)
+            self.filename = Path(myprositlib)
         elif isinstance(myprositlib, pd.DataFrame):
-            self.prositlib = myprositlib
+            self._prositlib = myprositlib
+
+    @property
+    def prositlib(self):
+        """The library dataframe, a library csv is read on first use"""
+
+        if self._prositlib is None:
+            self._prositlib = pd.read_csv(self.filename)
+        return self._prositlib
+
+    @prositlib.setter
+    def prositlib(self, prositlib):
+        self._prositlib = prositlib
 
     def remove_carbamidomethyl(self):
         """Remove carbamidomethylated prosit peptides"""
@@ -473,59 +1777,235 @@ class PrositLib(FileHandeling):
     def _replace_modified_seq(self):
         """Replace prosit modifications to original maxquant modfications"""
 
-        self.prositlib["ModifiedPeptide"] = self.prositlib["ModifiedPeptide"].str.replace("[Carbamidomethyl (C)]", "(ca)", regex=False)
-        self.prositlib["ModifiedPeptide"] = self.prositlib["ModifiedPeptide"].str.replace("[Oxidation (O)]", "(ox)", regex=False)
-        self.prositlib["ModifiedPeptide"] = self.prositlib["ModifiedPeptide"].str.extract(r"_([A-Za-z\(\)]*)_")
+        codes, modified_peptides = pd.factorize(self.prositlib["ModifiedPeptide"])
+        modified_peptides = pd.Series(modified_peptides, dtype=object)
+        modified_peptides = modified_peptides.str.replace("[Carbamidomethyl (C)]", "(ca)", regex=False)
+        modified_peptides = modified_peptides.str.replace("[Oxidation (O)]", "(ox)", regex=False)
+        modified_peptides = modified_peptides.str.extract(r"_([A-Za-z\(\)]*)_", expand=False)
+        # every precursor is converted once, missing peptides (code -1) map to the appended NaN
+        self.prositlib["ModifiedPeptide"] = np.append(modified_peptides.to_numpy(dtype=object), np.nan)[codes]
+
+    def add_precursor_keys(self):
+        """Add the int64 precursor_key column, see encode_precursor_keys"""
+
+        if any(self.prositlib["ModifiedPeptide"].str.contains("_")):
+            self._replace_modified_seq()
+        self.prositlib["precursor_key"] = encode_precursor_keys(
+            self.prositlib["ModifiedPeptide"], self.prositlib["PrecursorCharge"]
+        )
 
     def merge_spec_ids(self, prosit_csv):
-        """merge prositlib with concomitant prosit csv on modified peptide & charge"""
+        """merge prositlib with concomitant prosit csv on the precursor key of modified peptide & charge"""
 
-        self._replace_modified_seq()
+        self.add_precursor_keys()
         prosit_csv_df = pd.read_csv(prosit_csv)[["spec_id","precursor_charge", "modified_sequence"]]
-        prosit_csv_df.rename(
-            {"precursor_charge": "PrecursorCharge", "modified_sequence": "ModifiedPeptide"},
-            axis=1,
-            inplace=True
+        prosit_csv_df["precursor_key"] = encode_precursor_keys(
+            prosit_csv_df["modified_sequence"], prosit_csv_df["precursor_charge"]
         )
         self.prositlib = pd.merge(
             self.prositlib,
-            prosit_csv_df,
-            on=["ModifiedPeptide", "PrecursorCharge"],
+            prosit_csv_df[["precursor_key", "spec_id"]],
+            on="precursor_key",
             how="inner",
             validate="many_to_one"
         )
 
-    def create_pred_and_emp_csv(self, ms2pip_pred_and_emp_csv):
+    pred_emp_columns = ["spec_id", "charge", "ion", "ionnumber", "mz", "target"]
+    prosit_pred_emp_columns = [
+        "spec_id",
+        "RelativeIntensity",
+        "FragmentMz",
+        "PrecursorCharge",
+        "FragmentNumber",
+        "FragmentType",
+        "FragmentCharge",
+    ]
+
+    def _to_pred_emp_format(self, prositlib):
+        """Select and rename prosit library columns to pred_and_emp columns"""
+
+        prosit_pred_emp = prositlib[self.prosit_pred_emp_columns].copy()
+        prosit_pred_emp.rename({"RelativeIntensity": "prediction","PrecursorCharge": "charge","FragmentType": "ion", "FragmentNumber": "ionnumber"}, axis=1, inplace=True)
+        prosit_pred_emp = prosit_pred_emp[prosit_pred_emp["FragmentCharge"] == 1]
+        prosit_pred_emp["ion"] = prosit_pred_emp["ion"].str.upper()
+        prosit_pred_emp["charge"] = prosit_pred_emp["charge"].astype(np.int64)
+
+        return prosit_pred_emp
+
+    def _merge_pred_and_emp(self, prosit_pred_emp, pred_emp_csv, ce):
+        """Right-merge prosit predictions on ms2pip targets and log2 transform"""
+
+        prosit_pred_emp = prosit_pred_emp.merge(pred_emp_csv, on=["spec_id", "ion", "ionnumber", "charge"], how="right")
+        prosit_pred_emp["FragmentMz"] = prosit_pred_emp["FragmentMz"].fillna(prosit_pred_emp["mz"])
+        prosit_pred_emp["prediction"] = prosit_pred_emp["prediction"].fillna(0)
+        prosit_pred_emp["ce"] = ce
+        prosit_pred_emp["prediction"] = np.log2(prosit_pred_emp["prediction"] + 0.001)
+
+        return prosit_pred_emp
+
+    def _pred_and_emp_filename(self):
+        return (self.filename.parent / (self.filename.stem + f"_pred_and_emp")).with_suffix(".csv")
+
+    def create_pred_and_emp_csv(self, ms2pip_pred_and_emp_csv, memory_budget=None, chunksize=1000000):
         """
         Create dataframe similar to pred_and_emp output of ms2pip
 
         input:
         ms2pip_pred_and_emp_csv: concomitant ms2pip_pred_and_emp_csv file with same spec_ids
+        memory_budget: optional memory budget in bytes, if given both inputs are
+            hash partitioned on spec_id and processed one partition at a time,
+            a library that is not loaded yet is streamed from its csv
+        chunksize: number of rows read at once in the partitioned mode
 
         output:
         pred_and_emp_csv like dataframe with prosit predictions
         """
 
-        pred_emp_csv = pd.read_csv(ms2pip_pred_and_emp_csv)[["spec_id", "charge", "ion", "ionnumber", "mz", "target"]]
-        prosit_pred_emp = self.prositlib[["spec_id","RelativeIntensity", "FragmentMz","PrecursorCharge","FragmentNumber","FragmentType", "FragmentCharge"]].copy()
-        prosit_pred_emp.rename({"RelativeIntensity": "prediction","PrecursorCharge": "charge","FragmentType": "ion", "FragmentNumber": "ionnumber"}, axis=1, inplace=True)
-        prosit_pred_emp = prosit_pred_emp[prosit_pred_emp["FragmentCharge"] == 1]
-        prosit_pred_emp["ion"] = prosit_pred_emp["ion"].str.upper()
-        prosit_pred_emp["charge"] = prosit_pred_emp["charge"].astype(np.int64)
+        if memory_budget:
+            self._create_pred_and_emp_csv_partitioned(
+                ms2pip_pred_and_emp_csv, memory_budget, chunksize
+            )
+            return
 
-        prosit_pred_emp = prosit_pred_emp.merge(pred_emp_csv, on=["spec_id", "ion", "ionnumber", "charge"], how="right")
-        prosit_pred_emp["FragmentMz"].fillna(prosit_pred_emp["mz"], inplace=True)
-        prosit_pred_emp["prediction"].fillna(0, inplace=True)
-        prosit_pred_emp["ce"] = self._parse_ce_value()
-        prosit_pred_emp["prediction"] = prosit_pred_emp["prediction"].apply(self._calculate_log2_intensity)
-        prosit_pred_emp.sort_values(by="spec_id", ascending=True, inplace=True)
+        pred_emp_csv = read_pred_and_emp(ms2pip_pred_and_emp_csv, columns=self.pred_emp_columns)
+        prosit_pred_emp = self._create_pred_and_emp(pred_emp_csv)
 
         prosit_pred_emp.to_csv(
-            (self.filename.parent / (self.filename.stem + f"_pred_and_emp")).with_suffix(".csv"),
+            self._pred_and_emp_filename(),
             index=False,
             header=True
         )
-    
+
+    def _create_pred_and_emp(self, pred_emp_csv):
+        """Merge the library on a loaded ms2pip pred_and_emp table, sorted on spec_id"""
+
+        prosit_pred_emp = self._to_pred_emp_format(self.prositlib)
+        prosit_pred_emp = self._merge_pred_and_emp(prosit_pred_emp, pred_emp_csv, self._parse_ce_value())
+        prosit_pred_emp.sort_values(by="spec_id", ascending=True, inplace=True)
+
+        return prosit_pred_emp
+
+    @classmethod
+    def create_pred_and_emp_csvs(cls, prosit_libraries, ms2pip_pred_and_emp_csv, processes=1, outname=None):
+        """
+        create_pred_and_emp_csv for a collision energy sweep
+
+        The ms2pip pred_and_emp csv is read once and shared by all libraries.
+        Every library gets its own _pred_and_emp csv, the correlations of all
+        libraries are returned as one long table.
+
+        Parameters
+        ----------
+        prosit_libraries: list
+            prosit library csv files with spec_ids, the CE is parsed from the filename
+        ms2pip_pred_and_emp_csv: str
+            concomitant ms2pip_pred_and_emp_csv file with same spec_ids
+        processes: int
+            number of libraries processed in parallel, default = 1
+        outname: str
+            optional csv file to write the combined correlations to
+
+        output:
+        dataframe with spec_id, ce, correlation metric (PCC or SA) and correlation
+        """
+
+        pred_emp_csv = read_pred_and_emp(ms2pip_pred_and_emp_csv, columns=cls.pred_emp_columns)
+        if processes > 1:
+            with ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=_init_pred_and_emp_worker,
+                initargs=(pred_emp_csv,),
+            ) as executor:
+                correlations = list(
+                    tqdm(executor.map(_process_ce_library, prosit_libraries), total=len(prosit_libraries))
+                )
+        else:
+            correlations = [
+                _process_ce_library(prosit_library, pred_emp_csv) for prosit_library in tqdm(prosit_libraries)
+            ]
+
+        correlations = pd.concat(correlations, ignore_index=True).melt(
+            id_vars=["spec_id", "ce"],
+            value_vars=["PCC", "SA"],
+            var_name="correlation metric",
+            value_name="correlation",
+        )
+        if outname:
+            correlations.to_csv(outname, index=False, header=True)
+
+        return correlations
+
+    def _iter_prositlib(self, chunksize):
+        """Iterate over the prosit library in chunks, from file unless it is already loaded"""
+
+        if self._prositlib is not None:
+            for start in range(0, len(self.prositlib), chunksize):
+                yield self.prositlib.iloc[start:start + chunksize]
+        else:
+            yield from pd.read_csv(
+                self.filename, usecols=self.prosit_pred_emp_columns, chunksize=chunksize
+            )
+
+    @staticmethod
+    def _write_partitions(chunk, partition_files, n_partitions):
+        """Append the rows of a chunk to the spec_id hash partition files"""
+
+        partitions = pd.util.hash_pandas_object(
+            chunk["spec_id"].astype(str), index=False
+        ).to_numpy() % n_partitions
+        for partition, partition_chunk in chunk.groupby(partitions):
+            partition_file = partition_files[partition]
+            partition_chunk.to_csv(
+                partition_file, index=False, mode="a", header=not os.path.exists(partition_file)
+            )
+
+    def _create_pred_and_emp_csv_partitioned(self, ms2pip_pred_and_emp_csv, memory_budget, chunksize):
+        """
+        Bounded-memory create_pred_and_emp_csv
+
+        Both inputs are hash partitioned on spec_id into temporary files, each
+        partition is merged and appended to the output on its own. Rows are
+        sorted on spec_id within a partition, so the output is grouped per
+        spec_id but not globally sorted.
+        """
+
+        ce = self._parse_ce_value()
+        input_size = os.path.getsize(ms2pip_pred_and_emp_csv)
+        if self._prositlib is not None:
+            input_size += int(self._prositlib.memory_usage(deep=True).sum())
+        else:
+            input_size += os.path.getsize(self.filename)
+        # parsed dataframes and the merge take a few times the size of the csv text
+        n_partitions = max(1, ceil(input_size * 4 / memory_budget))
+
+        outname = self._pred_and_emp_filename()
+        partition_folder = tempfile.mkdtemp(prefix="pred_and_emp_", dir=outname.parent)
+        try:
+            pred_emp_files = [os.path.join(partition_folder, f"ms2pip_{i}.csv") for i in range(n_partitions)]
+            prosit_files = [os.path.join(partition_folder, f"prosit_{i}.csv") for i in range(n_partitions)]
+            for chunk in pd.read_csv(ms2pip_pred_and_emp_csv, usecols=self.pred_emp_columns, chunksize=chunksize):
+                self._write_partitions(chunk, pred_emp_files, n_partitions)
+            for chunk in self._iter_prositlib(chunksize):
+                self._write_partitions(self._to_pred_emp_format(chunk), prosit_files, n_partitions)
+
+            header = True
+            for pred_emp_file, prosit_file in tqdm(zip(pred_emp_files, prosit_files), total=n_partitions):
+                if not os.path.exists(pred_emp_file):
+                    continue
+                pred_emp_csv = pd.read_csv(pred_emp_file, dtype={"spec_id": str})
+                if os.path.exists(prosit_file):
+                    prosit_pred_emp = pd.read_csv(prosit_file, dtype={"spec_id": str})
+                else:
+                    prosit_pred_emp = pd.DataFrame(
+                        columns=["spec_id", "prediction", "FragmentMz", "charge", "ionnumber", "ion", "FragmentCharge"]
+                    ).astype(pred_emp_csv[["spec_id", "charge", "ionnumber", "ion"]].dtypes.to_dict())
+                prosit_pred_emp = self._merge_pred_and_emp(prosit_pred_emp, pred_emp_csv, ce)
+                prosit_pred_emp.sort_values(by="spec_id", ascending=True, inplace=True)
+                prosit_pred_emp.to_csv(outname, index=False, header=header, mode="w" if header else "a")
+                header = False
+        finally:
+            shutil.rmtree(partition_folder, ignore_errors=True)
+
     def _parse_ce_value(self):
         """Parse ce value from filename"""
 
@@ -534,30 +2014,48 @@ class PrositLib(FileHandeling):
         return ce
 
     def join_spec_ids(self, idmapping):
-        """Merge the idmapping dataframe with spec_ids"""
-        
-        if any(self.prositlib["ModifiedPeptide"].str.contains("_")):
-            self._replace_modified_seq()
+        """
+        Merge the idmapping dataframe with spec_ids
+
+        A pep_id may map to several spec_ids, as written by
+        PeptideRecord.to_unique_prosit_csv, the predictions are then repeated
+        for every spec_id.
+        """
         
-        self.prositlib["pep_id"] = self.prositlib["ModifiedPeptide"] + "/" + self.prositlib["PrecursorCharge"].astype(str)
+        self.add_precursor_keys()
         id_map_df = pd.read_csv(idmapping)
-        self.prositlib = self.prositlib.merge(id_map_df, on="pep_id", how="inner", validate="m:1").reset_index(drop=True)
+        if "precursor_key" not in id_map_df.columns:
+            precursors = id_map_df["pep_id"].str.rsplit("/", n=1, expand=True)
+            id_map_df["precursor_key"] = encode_precursor_keys(precursors[0], precursors[1].astype(np.int64))
+        self.prositlib = self.prositlib.merge(id_map_df, on="precursor_key", how="inner", validate="m:m").reset_index(drop=True)
     
-    def _group_predictions(self, grouping_factors:list):
-        """ Group the predictions for each spectrum ID """
+    def calculate_prediction_correlation(self, grouping_factors:list, include_lists=True):
+        """
+        Calculate pearson correlation and spectral angle for targets and predictions
+
+        Parameters
+        ----------
+        grouping_factors: list
+            columns identifying one spectrum
+        include_lists: bool
+            add the per-spectrum prediction and target lists, default = True
+        """
 
-        prediction_df = self.prositlib.groupby(by=grouping_factors).agg({"prediction": list, "target": list}).reset_index()
-        prediction_df["length"] = prediction_df["prediction"].apply(len)
+        grouped = self.prositlib.groupby(by=grouping_factors)
+        group_numbers = grouped.ngroup().to_numpy()
+        in_group = group_numbers >= 0
+        order = np.argsort(group_numbers[in_group], kind="stable")
+        target = self.prositlib["target"].to_numpy(dtype=np.float64)[in_group][order]
+        prediction = self.prositlib["prediction"].to_numpy(dtype=np.float64)[in_group][order]
+
+        prediction_df = grouped.size().reset_index(name="length")
+        offsets = np.concatenate([[0], np.cumsum(prediction_df["length"].to_numpy())])
+        if include_lists:
+            prediction_df["prediction"] = [x.tolist() for x in np.split(prediction, offsets[1:-1])]
+            prediction_df["target"] = [x.tolist() for x in np.split(target, offsets[1:-1])]
+        correlations = self.batch_correlations(target, prediction, offsets)
+        prediction_df["PCC"] = correlations["PCC"]
+        prediction_df["SA"] = correlations["SA"]
         prediction_df = prediction_df[prediction_df["length"] > 2]
 
-        return prediction_df.drop("length", axis=1)
-        
-
-    def calculate_prediction_correlation(self, grouping_factors:list):
-        """Calculate pearson correlation and spectral angle for targets and predictions"""
-
-        prediction_df = self._group_predictions(grouping_factors)
-        prediction_df["PCC"] = prediction_df.apply(lambda x: self.ms2pip_pearson(x.target, x.prediction), axis=1)
-        prediction_df["SA"] = prediction_df.apply(lambda x: self.spectral_angle(x.target, x.prediction), axis=1)
-
-        return prediction_df
\ No newline at end of file
+        return prediction_df.drop("length", axis=1)
\ No newline at end of file
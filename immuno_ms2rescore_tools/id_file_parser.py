@@ -1,15 +1,44 @@
 """Extract PeptideRecord from identification file."""
 
 
+import numpy as np
 import pandas as pd
 from pyteomics import mzid
+from lxml import etree
 import os
 import re
-from typing import Dict, List
+import glob
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List
 import click
 from tqdm import tqdm
 import tomlkit
 
+from immuno_ms2rescore_tools.peprec_io import write_binary_peprec
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+MODIFICATION_CACHE_SIZE = 100000
+_MODIFICATION_PATTERN = re.compile(r"\(([^)]*)\)")
+_LOWERCASE_PATTERN = re.compile("[a-z]")
+_PD_MODIFICATION_PATTERN = re.compile(r"\((.*?)\)")
+_PD_RESIDUE_PATTERN = re.compile(r"([A-Z])(\d+)")
+_RAW_FILE_PATTERN = r"^(?P<raw_file>[^.]*)"
+_RAW_FILE_SCAN_PATTERN = r"^(?P<raw_file>[^.]*)(?:\.(?P<scan>[^.]*))?"
+
+
+@lru_cache(maxsize=MODIFICATION_CACHE_SIZE)
+def _cached_modifications(convert, value, *args):
+    """Modifications of one id file value, shared by all parsers, chunks and files"""
+    return convert(value, *args)
+
 
 class _IdFileParser:
     """ General file handeling methods."""
@@ -65,16 +94,79 @@ class _IdFileParser:
         elif self.validate_path() is False:
             raise TypeError("Not a valid filepath.")
 
-    def peprec_to_file(self, filename: str, separator: str):
-        """ Write peprec dataframe to file"""
+    def peprec_to_file(self, filename: str, separator: str, file_format="text"):
+        """
+        Write peprec dataframe to file
+
+        file_format: text (default), or parquet/feather for a filename.peprec.<format>
+        dataset partitioned on Raw file
+        """
 
-        if not os.path.exists(filename + ".peprec"):
-            self.peprec.to_csv(filename + ".peprec", separator, index=False, mode="w")
+        if file_format != "text":
+            write_binary_peprec(self.peprec, f"{filename}.peprec.{file_format}", file_format)
+        elif not os.path.exists(filename + ".peprec"):
+            self.peprec.to_csv(filename + ".peprec", sep=separator, index=False, mode="w")
         elif os.path.exists(filename + ".peprec"):
             self.peprec.to_csv(
-                filename + ".peprec", separator, index=False, header=False, mode="a"
+                filename + ".peprec", sep=separator, index=False, header=False, mode="a"
             )
 
+    @staticmethod
+    def _convert_unique(values, convert, *args):
+        """Group codes of values and convert(value, *args) of every unique value"""
+
+        codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=False)
+        return codes, [_cached_modifications(convert, value, *args) for value in uniques]
+
+    @staticmethod
+    def _map_modifications(values, convert, *args):
+        """
+        Convert every unique value once with convert(value, *args) and map back
+
+        args must be hashable, conversions are kept in a bounded LRU cache.
+        """
+
+        codes, converted = _IdFileParser._convert_unique(values, convert, *args)
+        unique_values = np.empty(len(converted), dtype=object)
+        unique_values[:] = converted
+        return unique_values[codes]
+
+    @staticmethod
+    def _map_columns(values, convert, n_columns, *args):
+        """_map_modifications for a convert returning n_columns values, one array per column"""
+
+        codes, converted = _IdFileParser._convert_unique(values, convert, *args)
+        columns = list(zip(*converted)) or [()] * n_columns
+        return tuple(np.array(column, dtype=object)[codes] for column in columns)
+
+    @staticmethod
+    def _extract_columns(values, pattern):
+        """
+        Named groups of pattern as columns, missing optional groups are empty strings
+
+        Uses pyarrow compute when available instead of per-row string methods.
+        """
+
+        if pa is not None:
+            groups = pc.extract_regex(pa.array(values, type=pa.string()), pattern)
+            return pd.DataFrame(
+                {
+                    field.name: groups.field(i).to_pandas()
+                    for i, field in enumerate(groups.type)
+                }
+            ).set_axis(values.index)
+        return values.str.extract(pattern).fillna("")
+
+    def to_peprec_iter(self, chunksize=None):
+        """
+        Yield the peprec in chunks
+
+        Parsers without chunked reading parse the whole file and yield it once.
+        """
+
+        self.to_peprec()
+        yield self.peprec
+
     def _load_toml(self, config):
         toml_file = ""
         with open(config, "rt") as f_in:
@@ -104,8 +196,11 @@ class MaxquantFileParser(_IdFileParser):
         ----------
         sequence: str
             msms.txt-style modified sequence
+        modification_map: dict
+            mapping of msms.txt modification tags to names, a dict or tuple of
+            (tag, name) pairs
         fixed_modification: dict
-            dictionary with fixed modifications
+            dictionary with fixed modifications, a dict or tuple of (name, residue) pairs
         """
         if not modification_map:
             modification_mapping = {
@@ -118,68 +213,96 @@ class MaxquantFileParser(_IdFileParser):
                 "de": "Deamidated",
             }
         else:
-            modification_mapping = modification_map
+            modification_mapping = dict(modification_map)
 
         if fixed_modifications:
             inv_mod_mapping = {v: k for k, v in modification_mapping.items()}
-            for mod_name, aa in fixed_modifications.items():
+            for mod_name, aa in dict(fixed_modifications).items():
                 mod_tag = inv_mod_mapping[mod_name]
                 sequence = sequence.replace(aa, f"{aa}({mod_tag})")
 
-        modifications = []
         if "(" not in sequence:
-            modifications = "-"
-        else:
-            while re.match(r".*\(([^)]*)\).*", sequence):
-                x = re.search(r"\(([^)]*)\)", sequence)
-                modifications.append(
-                    [str(x.start() - 1), modification_mapping[x.group().strip("()")]]
-                )
-                sequence = re.sub(r"\(([^)]*)\)", "", sequence, 1)
-            modifications = ["|".join(tups) for tups in modifications]
-            modifications = "|".join(modifications)
-        return modifications
-
-    def to_peprec(self):
-        peprec = pd.DataFrame(
-            columns=[
-                "spec_id",
-                "peptide",
-                "modifications",
-                "charge",
-                "psm_score",
-                "observed_retention_time",
-                "Label",
-                "Raw file",
-            ]
+            return "-"
+        modifications = []
+        # locations are counted without the preceding tags and the leading underscore
+        removed = 1
+        for x in _MODIFICATION_PATTERN.finditer(sequence):
+            modifications.append(f"{x.start() - removed}|{modification_mapping[x.group().strip('()')]}")
+            removed += x.end() - x.start()
+        return "|".join(modifications)
+
+    msms_dtypes = {
+        "Raw file": str,
+        "Scan number": "int64",
+        "Sequence": str,
+        "Modified sequence": str,
+        "Charge": "int64",
+        "Score": "float64",
+        "Retention time": "float64",
+        "Reverse": str,
+    }
+
+    def _read_msms(self, chunksize=None):
+        """Read only the msms.txt columns needed for the peprec"""
+
+        return pd.read_table(
+            self.path_to_id_file,
+            sep="\t",
+            usecols=list(self.msms_dtypes),
+            dtype=self.msms_dtypes,
+            chunksize=chunksize,
         )
 
-        if self._id_df.empty:
-            self._id_df = pd.read_table(self.path_to_id_file, sep="\t")
+    def _msms_to_peprec(self, id_df):
+        """Convert (a chunk of) msms.txt to peprec"""
 
-        peprec["spec_id"] = "controllerType=0 controllerNumber=1 scan=" + self._id_df[
-            "Scan number"
-        ].astype(str)
-        peprec["peptide"] = self._id_df["Sequence"]
         if not self.config:
-            peprec["modifications"] = self._id_df["Modified sequence"].apply(
-                lambda x: self._get_peprec_modifications(x)
+            modifications = self._map_modifications(
+                id_df["Modified sequence"], self._get_peprec_modifications
             )
         else:
-            peprec["modifications"] = self._id_df["Modified sequence"].apply(
-                lambda x: self._get_peprec_modifications(
-                    x,
-                    self.config["modification_map"],
-                    self.config["fixed_modifications"],
-                )
+            modifications = self._map_modifications(
+                id_df["Modified sequence"],
+                self._get_peprec_modifications,
+                tuple(self.config["modification_map"].items()),
+                tuple(self.config["fixed_modifications"].items()),
             )
-        peprec["charge"] = self._id_df["Charge"]
-        peprec["psm_score"] = self._id_df["Score"]
-        peprec["observed_retention_time"] = self._id_df["Retention time"]
-        peprec["Label"] = self._id_df["Reverse"].isna().apply(lambda x: 1 if x else -1)
-        peprec["Raw file"] = self._id_df["Raw file"]
 
-        self.peprec = peprec
+        return pd.DataFrame(
+            {
+                "spec_id": "controllerType=0 controllerNumber=1 scan="
+                + id_df["Scan number"].astype(str),
+                "peptide": id_df["Sequence"],
+                "modifications": modifications,
+                "charge": id_df["Charge"],
+                "psm_score": id_df["Score"],
+                "observed_retention_time": id_df["Retention time"],
+                "Label": np.where(id_df["Reverse"].isna(), 1, -1),
+                "Raw file": id_df["Raw file"],
+            },
+            index=id_df.index,
+        )
+
+    def to_peprec(self):
+        if self._id_df.empty:
+            self._id_df = self._read_msms()
+
+        self.peprec = self._msms_to_peprec(self._id_df)
+
+    def to_peprec_iter(self, chunksize=1000000):
+        """
+        Read msms.txt in chunks of chunksize PSMs and yield the peprec of each chunk
+
+        Only the needed columns are read, so memory is bounded by the chunk size.
+        """
+
+        if not self._id_df.empty or not chunksize:
+            self.to_peprec()
+            yield self.peprec
+            return
+
+        for id_df in self._read_msms(chunksize=chunksize):
+            yield self._msms_to_peprec(id_df)
 
 
 class CometFileParser(_IdFileParser):
@@ -192,59 +315,56 @@ class CometFileParser(_IdFileParser):
     def _get_peprec_modifications(sequences, mods_requiring_suffix=None):
         """Get peprec-formatted modifications."""
 
-        if not mods_requiring_suffix:
-            mods_requiring_suffix = []
-        parsed_modifications = []
+        mods_requiring_suffix = tuple(mods_requiring_suffix or ())
+        return list(
+            _IdFileParser._map_modifications(
+                sequences, CometFileParser._get_sequence_modifications, mods_requiring_suffix
+            )
+        )
+
+    @staticmethod
+    def _get_sequence_modifications(sequence, mods_requiring_suffix=()):
+        """Get the peprec-formatted modifications of one sequence"""
 
-        for sequence in sequences:
-            mod = []
-            if "(" not in sequence:
-                parsed_modifications.append("-")
-            else:
-                while re.match(r".*\(([^)]*)\).*", sequence):
-                    x = re.search(r"\(([^)]*)\)", sequence)
-                    loc = int(x.start())
-                    name = x.group().strip("()")
-                    if name in mods_requiring_suffix:
-                        name = name + sequence[loc - 1]
-                    mod.extend([str(loc), name])
-                    sequence = re.sub(r"\(([^)]*)\)", "", sequence, 1)
-                mod = "|".join(mod)
-                parsed_modifications.append(mod)
-        return parsed_modifications
+        if "(" not in sequence:
+            return "-"
+        mod = []
+        removed = 0
+        previous_end = 0
+        residue = ""
+        for x in _MODIFICATION_PATTERN.finditer(sequence):
+            loc = x.start() - removed
+            name = x.group().strip("()")
+            if x.start() > previous_end:
+                residue = sequence[x.start() - 1]
+            if name in mods_requiring_suffix:
+                # a tag at the start takes the last residue, like sequence[-1]
+                name = name + (residue if loc > 0 else sequence[-1])
+            mod.extend([str(loc), name])
+            removed += x.end() - x.start()
+            previous_end = x.end()
+        return "|".join(mod)
 
     def to_peprec(self):
-        peprec = pd.DataFrame(
-            columns=[
-                "spec_id",
-                "peptide",
-                "modifications",
-                "charge",
-                "psm_score",
-                "observed_retention_time",
-                "Label",
-                "Raw file",
-            ]
-        )
-
         if self._id_df.empty:
             self._id_df = pd.read_table(self.path_to_id_file, sep="\t")
 
-        peprec["spec_id"] = "controllerType=0 controllerNumber=1 scan=" + self._id_df[
-            "ScanNr"
-        ].astype(str)
-        peprec["peptide"] = self._id_df["Sequence"]
-        peprec["modifications"] = self._get_peprec_modifications(self._id_df["Peptide"])
-        peprec["charge"] = self._id_df["Charge"]
-        peprec["psm_score"] = self._id_df["Comet.SpScore"]
-        peprec["observed_retention_time"] = self._id_df["RT"]
-        peprec["Label"] = self._id_df["IsDecoy"].apply(lambda x: 1 if x else -1)
-        raw_files = []
-        for i in self._id_df.Spectrum:
-            raw_file, _, _ = i.partition(".")
-            raw_files.append(raw_file)
-        peprec["Raw file"] = raw_files
-        self.peprec = peprec
+        self.peprec = pd.DataFrame(
+            {
+                "spec_id": "controllerType=0 controllerNumber=1 scan="
+                + self._id_df["ScanNr"].astype(str),
+                "peptide": self._id_df["Sequence"],
+                "modifications": self._map_modifications(
+                    self._id_df["Peptide"], self._get_sequence_modifications, ()
+                ),
+                "charge": self._id_df["Charge"],
+                "psm_score": self._id_df["Comet.SpScore"],
+                "observed_retention_time": self._id_df["RT"],
+                "Label": np.where(self._id_df["IsDecoy"].astype(bool), 1, -1),
+                "Raw file": self._extract_columns(self._id_df["Spectrum"], _RAW_FILE_PATTERN)["raw_file"],
+            },
+            index=self._id_df.index,
+        )
 
 
 class PeaksFileParser(_IdFileParser):
@@ -252,106 +372,144 @@ class PeaksFileParser(_IdFileParser):
         super().__init__(path_to_id_file, search_engine="Peaks")
 
     @staticmethod
-    def _get_peprec_modifications(modifications: List):
-        """ get peprec modifications out of the peaks id file"""
+    def _get_key_modifications(key):
+        """peprec modifications of (location, name, residues) tuples"""
         suffix_list = ["Phospho"]
-        if isinstance(modifications, List):
-            mods = []
-            for m in modifications:
-                if m["name"] in suffix_list:
-                    mods.append(f"{m['location']}|{m['name'] + m['residues'][0]}")
-                elif "residues" not in m.keys() and m["location"] != 0:
-                    mods.append(f"-1|{m['name']}")
-                else:
-                    mods.append(f"{m['location']}|{m['name']}")
-            return "|".join(mods)
-        else:
-            raise TypeError
-
-    def convert_flatten(self, d, parent_key="", sep="_"):
-        items = []
-        for k, v in d.items():
-            new_key = parent_key + sep + k if parent_key else k
-
-            if isinstance(v, Dict):
-                items.extend(self.convert_flatten(v, new_key, sep=sep))
-            elif isinstance(v, List):
-                if isinstance(v[0], Dict) and k != "Modification":
-                    items.extend(self.convert_flatten(v[0], new_key, sep=sep))
-                elif isinstance(v[0], Dict) and k == "Modification":
-                    items.append((new_key, v))
-                else:
-                    items.append((new_key, v[0]))
+        mods = []
+        for location, name, residues in key:
+            if name in suffix_list:
+                mods.append(f"{location}|{name + residues[0]}")
+            elif residues is None and location != 0:
+                mods.append(f"-1|{name}")
             else:
-                items.append((new_key, v))
-        return items
+                mods.append(f"{location}|{name}")
+        return "|".join(mods)
 
-    def to_peprec(self):
+    @staticmethod
+    def _get_raw_file(location):
+        return location.rsplit("/", 1)[-1].split(".", 1)[0].replace(",", "_", 1)
 
-        self.peprec = pd.DataFrame(
-            columns=[
-                "spec_id",
-                "peptide",
-                "modifications",
-                "charge",
-                "psm_score",
-                "Label",
-                "Raw file",
-            ]
-        )
-        with mzid.read(self.path_to_id_file) as reader:
-            for spectrum_identification_result in tqdm(reader):
-                retrieved_data = pd.Series(
-                    index=[
-                        "spec_id",
-                        "peptide",
-                        "modifications",
-                        "charge",
-                        "protein_list",
-                        "psm_score",
-                        "Label",
-                        "Raw file",
-                    ]
-                )
-                flat_dict = dict(self.convert_flatten(spectrum_identification_result))
-                spec_id = (
-                    flat_dict["location"]
-                    .rsplit("/", 1)[1]
-                    .split(".", 1)[0]
-                    .replace(",", "_", 1)
-                    + ":"
-                    + flat_dict["spectrumID"]
+    @staticmethod
+    def _local_name(element):
+        return etree.QName(element).localname
+
+    @staticmethod
+    def _parse_peptide(peptide):
+        """Sequence and peprec modifications of a Peptide element"""
+
+        sequence = None
+        key = []
+        for child in peptide:
+            name = PeaksFileParser._local_name(child)
+            if name == "PeptideSequence":
+                sequence = child.text
+            elif name == "Modification":
+                residues = child.get("residues")
+                mod_name = next(
+                    (param.get("name") for param in child.iterchildren("{*}cvParam")), None
                 )
-                retrieved_data["spec_id"] = spec_id
-                retrieved_data["peptide"] = flat_dict[
-                    "SpectrumIdentificationItem_PeptideSequence"
-                ]
-                try:
-                    retrieved_data["modifications"] = self._get_peprec_modifications(
-                        flat_dict["SpectrumIdentificationItem_Modification"]
+                key.append(
+                    (
+                        int(child.get("location")),
+                        mod_name,
+                        tuple(residues.split()) if residues is not None else None,
                     )
-                except KeyError:
-                    retrieved_data["modifications"] = "-"
-                retrieved_data["charge"] = flat_dict[
-                    "SpectrumIdentificationItem_chargeState"
-                ]
-                retrieved_data["protein_list"] = flat_dict[
-                    "SpectrumIdentificationItem_PeptideEvidenceRef_accession"
-                ]
-                retrieved_data["psm_score"] = flat_dict[
-                    "SpectrumIdentificationItem_PEAKS:peptideScore"
-                ]
-                retrieved_data["Label"] = flat_dict[
-                    "SpectrumIdentificationItem_PeptideEvidenceRef_isDecoy"
-                ]
-                retrieved_data["Raw file"] = (
-                    flat_dict["location"]
-                    .rsplit("/", 1)[1]
-                    .split(".", 1)[0]
-                    .replace(",", "_", 1)
                 )
-                self.peprec = self.peprec.append(retrieved_data, ignore_index=True)
-            self.peprec["Label"] = self.peprec["Label"].apply(lambda x: -1 if x else 1)
+        if not key:
+            return sequence, "-"
+        return sequence, _cached_modifications(PeaksFileParser._get_key_modifications, tuple(key))
+
+    @staticmethod
+    def _get_peptide_score(identification_item):
+        for param in identification_item:
+            if param.get("name") == "PEAKS:peptideScore":
+                return float(param.get("value"))
+        return np.nan
+
+    def _iter_identifications(self):
+        """
+        Stream the first SpectrumIdentificationItem of every SpectrumIdentificationResult
+
+        Spectra data, proteins, peptides and peptide evidence precede the
+        results in mzIdentML and are kept in lookup tables. Every completed
+        element outside these is cleared as well, including sections that are
+        not parsed such as ProteinDetectionList, so memory does not grow with
+        the size of the file.
+        """
+
+        raw_files = dict()
+        accessions = dict()
+        peptides = dict()
+        evidences = dict()
+        handled = {
+            "SpectraData",
+            "DBSequence",
+            "Peptide",
+            "PeptideEvidence",
+            "SpectrumIdentificationResult",
+        }
+        # number of open handled elements, their children are read by the handler
+        depth = 0
+        for event, element in etree.iterparse(
+            self.path_to_id_file, events=("start", "end"), huge_tree=True
+        ):
+            name = element.tag.rpartition("}")[2]
+            if event == "start":
+                if name in handled:
+                    depth += 1
+                continue
+            if name in handled:
+                depth -= 1
+            if name == "SpectrumIdentificationResult":
+                identification_item = next(element.iterchildren("{*}SpectrumIdentificationItem"))
+                evidence_ref = next(identification_item.iterchildren("{*}PeptideEvidenceRef"))
+                raw_file = raw_files[element.get("spectraData_ref")]
+                peptide, modifications = peptides[identification_item.get("peptide_ref")]
+                accession, is_decoy = evidences[evidence_ref.get("peptideEvidence_ref")]
+                yield (
+                    raw_file + ":" + element.get("spectrumID"),
+                    peptide,
+                    modifications,
+                    int(identification_item.get("chargeState")),
+                    self._get_peptide_score(identification_item),
+                    -1 if is_decoy else 1,
+                    raw_file,
+                    accession,
+                )
+            elif name == "Peptide":
+                peptides[element.get("id")] = self._parse_peptide(element)
+            elif name == "PeptideEvidence":
+                evidences[element.get("id")] = (
+                    accessions.get(element.get("dBSequence_ref")),
+                    element.get("isDecoy", "false").lower() in ("true", "1"),
+                )
+            elif name == "DBSequence":
+                accessions[element.get("id")] = element.get("accession")
+            elif name == "SpectraData":
+                raw_files[element.get("id")] = self._get_raw_file(element.get("location"))
+            if depth:
+                continue
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def to_peprec(self):
+        columns = [
+            "spec_id",
+            "peptide",
+            "modifications",
+            "charge",
+            "psm_score",
+            "Label",
+            "Raw file",
+            "protein_list",
+        ]
+        buffers = [[] for _ in columns]
+        for identification in tqdm(self._iter_identifications()):
+            for buffer, value in zip(buffers, identification):
+                buffer.append(value)
+
+        self.peprec = pd.DataFrame(dict(zip(columns, buffers)))
 
 
 class SpectrumMillFileParser(_IdFileParser):
@@ -371,57 +529,38 @@ class SpectrumMillFileParser(_IdFileParser):
             "t": ("T", "PhosphoT"),
             "s": ("S", "PhosphoS"),
         }
-        modification = []
         if sequence.isupper():
             return sequence, "-"
-        else:
-            while re.match(".*[a-z].*", sequence):
-                lc = re.search("[a-z]", sequence)
-                modification.append(
-                    [str(lc.start() + 1), modification_map[lc.group()][1]]
-                )
-                sequence = re.sub("[a-z]", modification_map[lc.group()][0], sequence, 1)
-            modification = ["|".join(tups) for tups in modification]
-            modification = "|".join(modification)
-        return sequence, modification
-
-    @staticmethod
-    def _get_filename_and_scannumber(filename: str):
-        rawfilename, _, scannumber = filename.partition(".")
-        scannumber = scannumber.split(".")
-        scannumber = scannumber[0]
-        return rawfilename, scannumber
+        modification = []
+        residues = list(sequence)
+        for lc in _LOWERCASE_PATTERN.finditer(sequence):
+            residue, name = modification_map[lc.group()]
+            modification.append(f"{lc.start() + 1}|{name}")
+            residues[lc.start()] = residue
+        return "".join(residues), "|".join(modification)
 
     def to_peprec(self):
-        peprec = pd.DataFrame(
-            columns=[
-                "spec_id",
-                "peptide",
-                "modifications",
-                "charge",
-                "protein_list",
-                "psm_score",
-                "observed_retention_time",
-                # "Label",
-                "Raw file",
-            ]
-        )
         if self._id_df.empty:
             self._id_df = pd.read_table(self.path_to_id_file, sep=";")
 
-        peprec[["Raw file", "spec_id"]] = pd.DataFrame(
-            self._id_df["filename"].apply(self._get_filename_and_scannumber).tolist(),
-            index=self._id_df.index,
+        filename = self._extract_columns(self._id_df["filename"], _RAW_FILE_SCAN_PATTERN)
+        peptide, modifications = self._map_columns(
+            self._id_df["sequence"], self._get_peprec_modifications, 2
         )
-        peprec[["peptide", "modifications"]] = pd.DataFrame(
-            self._id_df.sequence.apply(self._get_peprec_modifications).tolist(),
-            index=peprec.index,
+        self.peprec = pd.DataFrame(
+            {
+                "spec_id": filename["scan"],
+                "peptide": peptide,
+                "modifications": modifications,
+                "charge": self._id_df["parent_charge"],
+                "protein_list": np.nan,
+                "psm_score": self._id_df["score"],
+                "observed_retention_time": self._id_df["retentionTimeMin"],
+                # "Label",
+                "Raw file": filename["raw_file"],
+            },
+            index=self._id_df.index,
         )
-        peprec["charge"] = self._id_df["parent_charge"]
-        peprec["psm_score"] = self._id_df["score"]
-        peprec["observed_retention_time"] = self._id_df["retentionTimeMin"]
-
-        self.peprec = peprec
 
 
 class ProteomeDiscoverer(_IdFileParser):
@@ -440,8 +579,8 @@ class ProteomeDiscoverer(_IdFileParser):
         peprec_modifications = []
 
         for m in mod_list:
-            mod = re.search(r"\((.*?)\)", m)
-            aa_loc = re.match(r"([A-Z])(\d+)", m)
+            mod = _PD_MODIFICATION_PATTERN.search(m)
+            aa_loc = _PD_RESIDUE_PATTERN.match(m)
             if not aa_loc:
                 loc = term_mapper[m[: mod.start()]]
             else:
@@ -458,47 +597,166 @@ class ProteomeDiscoverer(_IdFileParser):
         return "|".join(peprec_modifications)
 
     def to_peprec(self):
-        peprec = pd.DataFrame(
-            columns=[
-                "spec_id",
-                "peptide",
-                "modifications",
-                "charge",
-                # "protein_list",
-                "psm_score",
-                "observed_retention_time",
-                "q-value",
-                "Raw file",
-            ]
-        )
         if self._id_df.empty:
             self._id_df = pd.read_table(
                 self.path_to_id_file,
             )
 
-        peprec["Raw file"] = self._id_df["Spectrum File"].apply(lambda x: x.split('.')[0])
-        peprec["spec_id"] = "controllerType=0 controllerNumber=1 scan=" + self._id_df["PSMs Peptide ID"].astype(str)
         if "Sequence" in self._id_df.keys():
-            peprec["peptide"] = self._id_df["Sequence"].str.upper()
+            peptide = self._id_df["Sequence"].str.upper()
         elif "Annotated Sequence" in self._id_df.keys():
-            peprec["peptide"] = (
+            peptide = (
                 self._id_df["Annotated Sequence"]
-                .apply(lambda x: re.search(r"\].([A-z]*).\[", x).group(1))
+                .str.extract(r"\].([A-z]*).\[", expand=False)
                 .str.upper()
             )
-        peprec["modifications"] = self._id_df["Modifications"].apply(
-            self._get_peprec_modifications
+        else:
+            peptide = np.nan
+        self.peprec = pd.DataFrame(
+            {
+                "spec_id": "controllerType=0 controllerNumber=1 scan="
+                + self._id_df["PSMs Peptide ID"].astype(str),
+                "peptide": peptide,
+                "modifications": self._map_modifications(
+                    self._id_df["Modifications"], self._get_peprec_modifications
+                ),
+                "charge": self._id_df["Charge"],
+                # "protein_list",
+                "psm_score": self._id_df["DeltaScore"],
+                "observed_retention_time": self._id_df["RT [min]"],
+                "q-value": self._id_df["Percolator q-Value"],
+                "Raw file": self._extract_columns(self._id_df["Spectrum File"], _RAW_FILE_PATTERN)["raw_file"],
+            },
+            index=self._id_df.index,
         )
-        peprec["charge"] = self._id_df["Charge"]
-        peprec["psm_score"] = self._id_df["DeltaScore"]
-        peprec["observed_retention_time"] = self._id_df["RT [min]"]
-        peprec["q-value"] = self._id_df["Percolator q-Value"]
 
-        self.peprec = peprec
+
+# read back as text, e.g. raw file names like 01 are not numbers
+_TEXT_COLUMN_DTYPES = {
+    "spec_id": str,
+    "peptide": str,
+    "modifications": str,
+    "Raw file": str,
+    "protein_list": str,
+}
+
+
+def _parse_id_file(id_file, search_engine, config, shard, chunksize=None):
+    """Parse one id file to a text peprec shard, pool worker of parse_id_files"""
+
+    if config:
+        id_file_parser = _IdFileParser.get_id_file_parser(search_engine, id_file, config)
+    else:
+        id_file_parser = _IdFileParser.get_id_file_parser(search_engine, id_file)
+    header = True
+    for peprec in id_file_parser.to_peprec_iter(chunksize):
+        peprec.to_csv(shard, sep=" ", index=False, header=header, mode="w" if header else "a")
+        header = False
+    return shard
+
+
+def expand_id_files(id_files):
+    """Expand glob patterns, files keep the given order and glob matches are sorted"""
+
+    expanded = []
+    for id_file in id_files:
+        matches = sorted(glob.glob(id_file)) if glob.has_magic(id_file) else [id_file]
+        if not matches:
+            raise FileNotFoundError(f"No id files match '{id_file}'")
+        expanded.extend(f for f in matches if f not in expanded)
+    return expanded
+
+
+def parse_id_files(
+    id_files,
+    search_engine,
+    output_filename,
+    config=None,
+    output_format="text",
+    processes=1,
+    chunksize=None,
+):
+    """
+    Parse several id files into one peprec
+
+    Every id file is parsed to a temporary text shard, in a process pool if
+    processes > 1. The shards are then joined in id file order, so the output
+    is the same for any number of processes and holds a single header.
+
+    Parameters
+    ----------
+    id_files: list
+        id files, in output order
+    search_engine: str
+        search engine that provided the id files
+    output_filename: str
+        name and directory for output peprec, without extension
+    config: str
+        optional config file with fixed modifications and modification mapping
+    output_format: str
+        text (default), parquet or feather, see _IdFileParser.peprec_to_file
+    processes: int
+        number of id files parsed in parallel, default = 1
+    chunksize: int
+        parse and join in chunks of this many PSMs
+    """
+
+    output_folder = os.path.dirname(os.path.abspath(output_filename))
+    shard_folder = tempfile.mkdtemp(prefix="peprec_shards_", dir=output_folder)
+    try:
+        shards = [os.path.join(shard_folder, f"{i}.peprec") for i in range(len(id_files))]
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [
+                    executor.submit(_parse_id_file, id_file, search_engine, config, shard, chunksize)
+                    for id_file, shard in zip(id_files, shards)
+                ]
+                for future in tqdm(futures):
+                    future.result()
+        else:
+            for id_file, shard in tqdm(zip(id_files, shards), total=len(id_files)):
+                _parse_id_file(id_file, search_engine, config, shard, chunksize)
+
+        shards = [shard for shard in shards if os.path.exists(shard)]
+        headers = set()
+        for shard in shards:
+            with open(shard) as f:
+                headers.add(f.readline())
+        if len(headers) > 1:
+            raise ValueError("Id files were parsed to peprecs with different columns")
+
+        if output_format == "text":
+            _join_text_shards(shards, output_filename + ".peprec")
+        else:
+            for shard in shards:
+                for peprec in pd.read_table(
+                    shard, sep=" ", dtype=_TEXT_COLUMN_DTYPES, chunksize=chunksize or 1000000
+                ):
+                    write_binary_peprec(peprec, f"{output_filename}.peprec.{output_format}", output_format)
+    finally:
+        shutil.rmtree(shard_folder, ignore_errors=True)
+
+
+def _join_text_shards(shards, peprec_file):
+    """Append text shards to peprec_file, with a header only if peprec_file is new"""
+
+    header = not os.path.exists(peprec_file)
+    with open(peprec_file, "a") as out:
+        for shard in shards:
+            with open(shard) as f:
+                shard_header = f.readline()
+                if header:
+                    out.write(shard_header)
+                    header = False
+                shutil.copyfileobj(f, out)
 
 
 @click.command()
-@click.option("--id_file", help="Filepath to identification file.")
+@click.option(
+    "--id_file",
+    multiple=True,
+    help="Filepath to identification file, a glob pattern or given multiple times.",
+)
 @click.option(
     "--search_engine", help="Search engine that provided identification file."
 )
@@ -508,15 +766,44 @@ class ProteomeDiscoverer(_IdFileParser):
     default=None,
     help="optional config file with fixed modifications and modification mapping",
 )
-def main(id_file, search_engine, output_filename, config):
+@click.option(
+    "--output_format",
+    default="text",
+    type=click.Choice(["text", "parquet", "feather"]),
+    help="space separated text peprec or Parquet/Feather dataset partitioned on Raw file",
+)
+@click.option(
+    "--chunksize",
+    default=None,
+    type=int,
+    help="parse and write the id file in chunks of this many PSMs (Maxquant only)",
+)
+@click.option(
+    "--processes", default=1, show_default=True, help="number of id files parsed in parallel"
+)
+def main(id_file, search_engine, output_filename, config, output_format, chunksize, processes):
+    id_files = expand_id_files(id_file)
+    if len(id_files) > 1:
+        parse_id_files(
+            id_files,
+            search_engine,
+            output_filename,
+            config=config,
+            output_format=output_format,
+            processes=processes,
+            chunksize=chunksize,
+        )
+        return
+
     if config:
         id_file_parser = _IdFileParser.get_id_file_parser(
-            search_engine, id_file, config
+            search_engine, id_files[0], config
         )
     else:
-        id_file_parser = _IdFileParser.get_id_file_parser(search_engine, id_file)
-    id_file_parser.to_peprec()
-    id_file_parser.peprec_to_file(output_filename, separator=" ")
+        id_file_parser = _IdFileParser.get_id_file_parser(search_engine, id_files[0])
+    for peprec in id_file_parser.to_peprec_iter(chunksize):
+        id_file_parser.peprec = peprec
+        id_file_parser.peprec_to_file(output_filename, separator=" ", file_format=output_format)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+import click
+
+from immuno_ms2rescore_tools import file_utilities
+
+@click.command()
+@click.option("--mgf_folder", help="mgf folder/file to convert")
+@click.option("--out", help="output spectrum store folder")
+@click.option("--mz_dtype", default="float64", help="m/z dtype, float32 or float64")
+@click.option("--intensity_dtype", default="float32", help="intensity dtype, float32 or float64")
+def main(mgf_folder, out, mz_dtype, intensity_dtype):
+    mgf_files = file_utilities.MascotGenericFormat(mgf_folder)
+    file_utilities.SpectrumStore.from_mgf(
+        mgf_files.filelist, out, mz_dtype=mz_dtype, intensity_dtype=intensity_dtype
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Read and write peprec files as space separated text or partitioned Parquet/Feather"""
+
+import os
+import uuid
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+    ds = None
+
+PEPREC_DTYPES = {
+    "spec_id": str,
+    "peptide": str,
+    "modifications": str,
+    "Raw file": "category",
+    "charge": "int8",
+    "Label": "int8",
+    "psm_score": "float64",
+    "observed_retention_time": "float32",
+    "q-value": "float32",
+}
+
+BINARY_FORMATS = ("parquet", "feather")
+
+
+def _require_pyarrow():
+    if ds is None:
+        raise ImportError("pyarrow is required for Parquet/Feather peprec files")
+
+
+def get_binary_format(path):
+    """Return parquet or feather for binary peprec paths, None for text peprecs"""
+
+    for file_format in BINARY_FORMATS:
+        if path.rstrip("/").endswith("." + file_format):
+            return file_format
+    return None
+
+
+def _raw_file_partitioning():
+    return ds.partitioning(pa.schema([("Raw file", pa.string())]), flavor="hive")
+
+
+def _to_typed_peprec(peprec):
+    """Cast the known peprec columns to PEPREC_DTYPES, nullable ints if values are missing"""
+
+    peprec = peprec.copy()
+    for column, dtype in PEPREC_DTYPES.items():
+        if column not in peprec.columns:
+            continue
+        if dtype == "int8" and peprec[column].isna().any():
+            dtype = "Int8"
+        peprec[column] = peprec[column].astype(dtype)
+    return peprec
+
+
+def write_binary_peprec(peprec, path, file_format="parquet", rows_per_group=100000):
+    """
+    Write a peprec to a Parquet or Feather dataset partitioned on Raw file
+
+    Every call adds new files to the dataset, existing partitions are kept,
+    similar to appending to a text peprec.
+
+    Parameters
+    ----------
+    peprec: pd.DataFrame
+        peprec to write
+    path: str
+        dataset folder
+    file_format: str
+        parquet (default) or feather
+    rows_per_group: int
+        maximum number of rows per row group, smaller groups allow finer
+        predicate pushdown
+    """
+
+    _require_pyarrow()
+    if file_format not in BINARY_FORMATS:
+        raise ValueError(f"Unknown peprec format '{file_format}'")
+    table = pa.Table.from_pandas(_to_typed_peprec(peprec), preserve_index=False)
+    if "Raw file" in table.column_names:
+        table = table.set_column(
+            table.column_names.index("Raw file"),
+            "Raw file",
+            table.column("Raw file").cast(pa.string()),
+        )
+        partitioning = _raw_file_partitioning()
+    else:
+        partitioning = None
+    ds.write_dataset(
+        table,
+        path,
+        format="ipc" if file_format == "feather" else file_format,
+        partitioning=partitioning,
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.{file_format}",
+        existing_data_behavior="overwrite_or_ignore",
+        max_rows_per_group=rows_per_group,
+        min_rows_per_group=min(rows_per_group, max(1, len(peprec))),
+    )
+
+
+def read_binary_peprec(path, columns=None, raw_files=None):
+    """
+    Read a partitioned Parquet or Feather peprec
+
+    Parameters
+    ----------
+    path: str
+        dataset folder
+    columns: list
+        only read these columns, default = all columns
+    raw_files: list
+        only read these runs, pushed down to the partitions
+    """
+
+    _require_pyarrow()
+    file_format = get_binary_format(path)
+    dataset = ds.dataset(
+        path,
+        format="ipc" if file_format == "feather" else file_format,
+        partitioning=_raw_file_partitioning(),
+    )
+    if columns:
+        columns = [column for column in columns if column in dataset.schema.names]
+    row_filter = ds.field("Raw file").isin(list(raw_files)) if raw_files is not None else None
+    peprec = dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+    if "Raw file" in peprec.columns:
+        peprec["Raw file"] = peprec["Raw file"].astype("category")
+    return peprec
+
+
+def iter_peprec(path, columns=None, chunksize=1000000):
+    """
+    Read a text or binary peprec in chunks of at most chunksize rows
+
+    Parameters
+    ----------
+    path: str
+        text peprec or binary peprec dataset folder
+    columns: list
+        only read these columns, default = all columns
+    chunksize: int
+        number of rows read at once
+    """
+
+    if get_binary_format(path) and os.path.isdir(path):
+        _require_pyarrow()
+        file_format = get_binary_format(path)
+        dataset = ds.dataset(
+            path,
+            format="ipc" if file_format == "feather" else file_format,
+            partitioning=_raw_file_partitioning(),
+        )
+        if columns:
+            columns = [column for column in columns if column in dataset.schema.names]
+        for batch in dataset.to_batches(columns=columns, batch_size=chunksize):
+            yield batch.to_pandas()
+        return
+    yield from pd.read_table(
+        path,
+        sep=" ",
+        usecols=(lambda column: column in columns) if columns else None,
+        chunksize=chunksize,
+    )
+
+
+def read_peprec(path, columns=None, raw_files=None, **kwargs):
+    """Read a text or binary peprec, text peprecs are read with pd.read_table"""
+
+    if get_binary_format(path) and os.path.isdir(path):
+        return read_binary_peprec(path, columns=columns, raw_files=raw_files)
+    peprec = pd.read_table(
+        path,
+        sep=" ",
+        usecols=(lambda column: column in columns) if columns else None,
+        **kwargs,
+    )
+    if raw_files is not None:
+        peprec = peprec[peprec["Raw file"].isin(raw_files)]
+    return peprec
@@ -1,16 +1,55 @@
 import click
+import pandas as pd
 
 from immuno_ms2rescore_tools import file_utilities
+from immuno_ms2rescore_tools.peprec_io import iter_peprec
+
+PROSIT_PEPREC_COLUMNS = ["spec_id", "peptide", "modifications", "charge"]
+
+
+def write_prosit_csv(peprec, ce, out, unique_precursors=False, chunksize=1000000):
+    """
+    Write the prosit csv of a peprec chunk by chunk
+
+    With unique_precursors every (modified sequence, charge) is written once
+    to {out}.csv and the spec_id to pep_id and precursor_key mapping to
+    {out}_idmapping.csv.
+    """
+
+    seen_precursors = set()
+    header = True
+    for chunk in iter_peprec(peprec, columns=PROSIT_PEPREC_COLUMNS, chunksize=chunksize):
+        chunk = file_utilities.PeptideRecord(chunk.reset_index(drop=True))
+        mode = "w" if header else "a"
+        if not unique_precursors:
+            prosit_csv = chunk.to_prosit_csv(ce)
+            prosit_csv.to_csv(f"{out}.csv", sep=",", header=header, index=False, mode=mode)
+            header = False
+            continue
+
+        prosit_csv, id_mapping = chunk.to_unique_prosit_csv(ce)
+        precursor_keys = file_utilities.encode_precursor_keys(
+            prosit_csv["modified_sequence"], prosit_csv["precursor_charge"]
+        )
+        new_precursors = ~pd.Series(precursor_keys).isin(seen_precursors).to_numpy()
+        seen_precursors.update(precursor_keys[new_precursors].tolist())
+        prosit_csv[new_precursors].to_csv(f"{out}.csv", sep=",", header=header, index=False, mode=mode)
+        id_mapping.to_csv(f"{out}_idmapping.csv", sep=",", header=header, index=False, mode=mode)
+        header = False
+
+    return len(seen_precursors)
+
 
 @click.command()
 @click.option("--peprec", help="peprec input file")
 @click.option("--ce", help="collision energy used")
 @click.option("--out", help="output_filename")
-def main(peprec, ce, out):
-    peprec = file_utilities.PeptideRecord(peprec)
-    prosit_csv = peprec.to_prosit_csv(ce)
-    prosit_csv.to_csv(f"{out}.csv", sep=",", header=True, index=False)
+@click.option("--unique_precursors", is_flag=True, help="write every precursor once and a spec_id to pep_id mapping to {out}_idmapping.csv")
+@click.option("--chunksize", default=1000000, show_default=True, help="number of peprec rows processed at once")
+def main(peprec, ce, out, unique_precursors, chunksize):
+    n_precursors = write_prosit_csv(peprec, ce, out, unique_precursors=unique_precursors, chunksize=chunksize)
+    if unique_precursors:
+        print(f"{n_precursors} unique precursors written to {out}.csv")
 
 if __name__ == "__main__":
     main()
-
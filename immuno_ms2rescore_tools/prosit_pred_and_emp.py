@@ -0,0 +1,16 @@
+import click
+
+from immuno_ms2rescore_tools import file_utilities
+
+@click.command()
+@click.option("--prosit_library", multiple=True, help="prosit library csv with spec_ids and the CE in the filename (ce30), can be given multiple times")
+@click.option("--ms2pip_pred_and_emp", help="concomitant ms2pip pred_and_emp csv")
+@click.option("--processes", default=1, show_default=True, help="number of libraries processed in parallel")
+@click.option("--out", help="output csv with the correlations of all libraries")
+def main(prosit_library, ms2pip_pred_and_emp, processes, out):
+    file_utilities.PrositLib.create_pred_and_emp_csvs(
+        list(prosit_library), ms2pip_pred_and_emp, processes=processes, outname=out
+    )
+
+if __name__ == "__main__":
+    main()
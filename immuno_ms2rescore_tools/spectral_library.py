@@ -6,17 +6,19 @@ import click
 
 
 class Spectrallibrary:
-    def __init__(self, peprec, mgf_file_list) -> pd.DataFrame:
+    def __init__(self, peprec, mgf_file_list, processes=1, fdr_level="run") -> pd.DataFrame:
         self.df = file_utilities.PeptideRecord(peprec)
         self.mgf_folder = mgf_file_list
+        self.processes = processes
+        self.fdr_level = fdr_level
 
     def create_spectral_library_from_pep(self, identifier):
         "Create a spectral library peprec with concomitant mgf file"
-        if "decoys" in self.df.peprec.keys():
+        if "Label" in self.df.peprec.keys():
             number_of_decoys = self.df.count_decoys()
             if number_of_decoys > 0:
-                print("Filtering out q values lower than 0.01")
-                self.df.filter_peprec_on_qvalue()
+                print(f"Filtering out {self.fdr_level} level q values lower than 0.01")
+                self.df.filter_peprec_on_qvalue(level=self.fdr_level)
                 print("Filtering out decoys")
                 self.df.filter_decoys()
         elif "q-values" in self.df.peprec.keys():
@@ -42,7 +44,8 @@ class Spectrallibrary:
         if identifier:
             self.df.create_usi(identifier)
             self.mgf.scan_mgf(
-                self.df.peprec, spec_id_name='USI', outname="spec_lib_" + self.df.peprec_name + ".mgf"
+                self.df.peprec, spec_id_name='USI', outname="spec_lib_" + self.df.peprec_name + ".mgf",
+                processes=self.processes,
             )
             self.df.peprec = self.df.peprec.drop("spec_id", axis=1)
             self.df.peprec = self.df.peprec.rename(columns={"USI": "spec_id"})
@@ -56,7 +59,8 @@ class Spectrallibrary:
             )
         else:
             self.mgf.scan_mgf(
-                self.df.peprec, spec_id_name="spec_id", outname="spec_lib_" + self.df.peprec_name + ".mgf"
+                self.df.peprec, spec_id_name="spec_id", outname="spec_lib_" + self.df.peprec_name + ".mgf",
+                processes=self.processes,
             )
 
 
@@ -64,8 +68,15 @@ class Spectrallibrary:
 @click.option("--peprec", help="peprec to create spectral library from")
 @click.option("--mgf_folder", help="mgf folder/file with concomitant spectra")
 @click.option("--identifier", default=None, help="Idenitifier for Universal Spectrum Identifier")
-def main(peprec, mgf_folder, identifier):
-    spectral_lib = Spectrallibrary(peprec, mgf_folder)
+@click.option("--processes", default=1, type=int, help="Number of processes used to extract spectra")
+@click.option(
+    "--fdr_level",
+    default="run",
+    type=click.Choice(["run", "psm", "peptide", "precursor"]),
+    help="Level at which the 1% FDR filter is applied",
+)
+def main(peprec, mgf_folder, identifier, processes, fdr_level):
+    spectral_lib = Spectrallibrary(peprec, mgf_folder, processes=processes, fdr_level=fdr_level)
     spectral_lib.create_spectral_library_from_pep(identifier)
 
 
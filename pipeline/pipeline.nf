@@ -100,30 +100,17 @@ process ThermoRawFileParser{
 process IdFileParser{
 
     input:
-    file idfile from Channel.fromPath(params.id_file, type: "file")
+    file idfiles from Channel.fromPath(params.id_file, type: "file").toSortedList()
     file config from opt_config
 
     output:
-    file "*.peprec" into peprec
+    file "*.peprec" into final_peprec
 
     script:
     def filter = config.name != 'NO_FILE' ? "--config $config" : ""
+    def id_file_args = [idfiles].flatten().collect { "--id_file $it" }.join(" ")
     """
-    python ../immuno_ms2rescore_tools/id_file_parser.py --id_file $idfile --search_engine $params.search_engine --output_filename $params.identifier
-    """
-}
-
-process ConcatPeprecFiles{
-
-    input:
-    path peprec from peprec.collectFile()
-
-    output:
-    file peprec into final_peprec
-
-    script:
-    """
-    sed -i '2,\${/^spec_id/d;}' $peprec
+    python ../immuno_ms2rescore_tools/id_file_parser.py $id_file_args --search_engine $params.search_engine --output_filename $params.identifier --processes $task.cpus
     """
 }
 
@@ -141,7 +128,7 @@ process CreateSpectralLibary{
 
     script:
     """
-    python ../immuno_ms2rescore_tools/spectral_library.py --peprec $peprec --mgf_folder . --identifier $params.identifier
+    python ../immuno_ms2rescore_tools/spectral_library.py --peprec $peprec --mgf_folder . --identifier $params.identifier --processes $task.cpus
     """
 }
 
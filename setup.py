@@ -19,6 +19,8 @@ setup(
         "spectral-library=immuno_ms2rescore_tools.spectral_library:main",
         "convert-model-to-C=immuno_ms2rescore_tools.convert_model_to_C:main",
         "peprec-to-prosit-csv=immuno_ms2rescore_tools.peprec_to_prosit_csv:main",
+        "mgf-to-spectrum-store=immuno_ms2rescore_tools.mgf_to_spectrum_store:main",
+        "prosit-pred-and-emp=immuno_ms2rescore_tools.prosit_pred_and_emp:main",
 
     ]},
 )
@@ -0,0 +1,70 @@
+from pyteomics.auxiliary import Charge
+
+from immuno_ms2rescore_tools.file_utilities import MascotGenericFormat, SpectrumStore
+
+MGF = """BEGIN IONS
+TITLE=run1.2.2 scan=2
+PEPMASS=500.25
+CHARGE=2+
+RTINSECONDS=10.5
+100.1 10.0
+200.2 20.0
+END IONS
+BEGIN IONS
+TITLE=run1.3.3 scan=3
+PEPMASS=600.5
+RTINSECONDS=11.5
+150.1 15.0
+END IONS
+BEGIN IONS
+TITLE=run1.2.2 scan=2
+PEPMASS=700.75
+CHARGE=3+
+RTINSECONDS=12.5
+300.3 30.0
+END IONS
+"""
+
+
+def _store(tmp_path):
+    mgf_file = tmp_path / "run1.mgf"
+    mgf_file.write_text(MGF)
+    return SpectrumStore.from_mgf([str(mgf_file)], str(tmp_path / "store"))
+
+
+def test_charge_round_trip(tmp_path):
+    store = _store(tmp_path)
+    reloaded = SpectrumStore(store.store_path)
+    assert str(reloaded.metadata["charge"].dtype) == "Int64"
+    assert reloaded.metadata["charge"].tolist()[0] == 2
+    assert reloaded.metadata["charge"].isna().tolist() == [False, True, False]
+
+
+def test_index_of_keeps_last_title(tmp_path):
+    store = _store(tmp_path)
+    assert store.index_of("run1.2.2 scan=2") == 2
+    assert store.index_of_scan("run1", 2) == 0
+    assert store.index_of_scan("run1", 3) == 1
+    assert store.index_of_scan("run1", 4) is None
+
+
+def test_write_store_spectra_charge(tmp_path):
+    store = _store(tmp_path)
+    mgf = MascotGenericFormat(store.store_path)
+    outname = str(tmp_path / "out.mgf")
+    mgf._write_store_spectra({"run1": {"2": "first", "3": "no_charge"}}, outname)
+    with open(outname) as f:
+        written = f.read()
+    assert "CHARGE=2+\n" in written
+    assert "CHARGE=3+\n" in written
+    assert written.count("CHARGE=") == 2
+    assert "CHARGE=<NA>" not in written
+
+
+def test_store_matches_mgf_folder(tmp_path):
+    store = _store(tmp_path)
+    from_folder = MascotGenericFormat(str(tmp_path / "run1.mgf")).retrieve_masses("run1.2.2 scan=2")
+    from_store = MascotGenericFormat(store.store_path).retrieve_masses("run1.2.2 scan=2")
+    assert from_store["precursor_mz"] == from_folder["precursor_mz"] == 700.75
+    assert isinstance(from_store["precursor_charge"], Charge)
+    assert from_store["precursor_charge"] == from_folder["precursor_charge"] == 3